@@ -1,78 +1,71 @@
-import arcpy
-from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 import itertools
+import os
+import sys
 
-arcpy.env.workspace=r"D:\Ashok\Catskills_Project\Inputs\Landuse"
-arcpy.env.overwriteOutput=True
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from class_scheme import load_scheme
+from raster_stats import class_counts
+
+# Class areas of every basin-year. The rasters are read block by block and counted with np.bincount (raster_stats.py),
+# all basin-years at once in worker processes, so memory stays flat whatever the raster size.
+
+landuse_dir=r"D:\Ashok\Catskills_Project\Inputs\Landuse"
 
 basins = ["WestDelaware", "ElkCreek", "TownBrooke"]
 years = [1996, 2001, 2006, 2010, 2016, 2021]
+workers = None  # processes; None = one per core
 
-class_names = {
-    1: "Unclassified",
-    2: "High Intensity Developed",
-    3: "Medium Intensity Developed",
-    4: "Low Intensity Developed",
-    5: "Developed Open Space",
-    6: "Cultivated",
-    7: "Pasture/Hay",
-    8: "Grassland",
-    9: "Deciduous Forest",
-    10: "Evergreen Forest",
-    11: "Mixed Forest",
-    12: "Scrub/Shrub",
-    13: "Palustrine Forested Wetland",
-    14: "Palustrine Scrub/Shrub Wetland",
-    15: "Palustrine Emergent Wetland",
-    16: "Estuarine Forested Wetland",
-    17: "Estuarine Scrub/Shrub Wetland",
-    18: "Estuarine Emergent Wetland",
-    19: "Unconsolidated Shore",
-    20: "Barren Land",
-    21: "Open Water",
-    22: "Palustrine Aquatic Bed",
-    23: "Estuarine Aquatic Bed",
-    24: "Tundra",
-    25: "Perennial Ice/Snow"
-}
+# Class names come from the shared class scheme config (see class_scheme.py)
+class_names = load_scheme().class_names
 
 
 result_log=fr"D:\Ashok\Catskills_Project\Inputs\Landuse\Subbasin_Results_Log.xlsx"
 pixel_area_ha = 0.01
+no_data = 999
 name_to_code = {name: code for code, name in class_names.items()}
 
-with pd.ExcelWriter(result_log) as writer:
-    
-    for basin in basins:
-        summary_df=pd.DataFrame()
 
-        for year in years:            
+def landuse_raster(basin, year):
+    # The resampled raster, or the warped VRT of LU_Warp.py when it hasn't been written out
+    tif = os.path.join(landuse_dir, basin, f"{basin}_{year}_ccap_LC_Resampled10m.tif")
+    vrt = os.path.splitext(tif)[0] + '.vrt'
+    return vrt if not os.path.exists(tif) and os.path.exists(vrt) else tif
+
+
+def area_summary(counts):
+    # Area (ha) of each class present, indexed by class name
+    classes = np.flatnonzero(counts)
+    area_ha = counts[classes] * pixel_area_ha
+    class_labels = [class_names.get(c, f"Class {c}") for c in classes.tolist()]
+    return pd.Series(area_ha, index=class_labels)
+
+
+def main():
+    jobs = list(itertools.product(basins, years))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {(basin, year): pool.submit(class_counts, landuse_raster(basin, year), (no_data,))
+                   for basin, year in jobs}
+
+    with pd.ExcelWriter(result_log) as writer:
+
+        for basin in basins:
+            summary_df=pd.DataFrame()
 
-            raster1=arcpy.Raster(fr"{basin}\{basin}_{year}_ccap_LC_Resampled10m.tif")
-            
+            for year in years:
+                summary_df[year] = area_summary(futures[(basin, year)].result())
 
-            raster = arcpy.Raster(str(raster1))
-            arr = arcpy.RasterToNumPyArray(raster)
-            arr = arr[arr != 999]
-            
+            summary_df['Class_Code'] = summary_df.index.map(name_to_code)
+            summary_df = summary_df.sort_values('Class_Code')
+            summary_df.index.name = "LandUseClass"
 
-            classes, counts = np.unique(arr, return_counts=True)
-            area_ha = counts * pixel_area_ha
+            summary_df.to_excel(writer, sheet_name=basin)
+            print(f" Wrote area summary for {basin}")
 
-            class_labels = [class_names.get(c, f"Class {c}") for c in classes]
-            summary_df[year] = pd.Series(area_ha, index=class_labels)
-        
-        summary_df['Class_Code'] = summary_df.index.map(name_to_code)
-        summary_df = summary_df.sort_values('Class_Code')
-        summary_df.index.name = "LandUseClass"
-        
-        summary_df.to_excel(writer, sheet_name=basin)
-        print(f" Wrote area summary for {basin}")
-    
-print(f"\n Summary saved to: {result_log}")    
+    print(f"\n Summary saved to: {result_log}")
 
-        
 
-        
+if __name__=='__main__':
+    main()
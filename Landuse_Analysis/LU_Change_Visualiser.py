@@ -2,26 +2,23 @@ import pandas as pd
 import matplotlib.pyplot as plt
 import seaborn as sns
 import numpy as np
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from class_scheme import load_scheme
 
 result_log=fr"D:\Ashok\Catskills_Project\Inputs\Landuse\Subbasin_Results_Log.xlsx"
+transition_log=fr"D:\Ashok\Catskills_Project\Inputs\Landuse\Subbasin_Transitions_Log.xlsx"  # from LU_Transitions.py
 basins = ["WestDelaware", "ElkCreek", "TownBrooke"]
 years = [1996, 2001, 2006, 2010, 2016, 2021]
-# Reclassification groups
-ag = [6, 7]
-urban = [2, 3, 4, 5, 20]
-good = [8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18]
-forest = [9, 10, 11]
-water_values = [19, 21, 22, 23]
+# Reclassification groups come from the shared class scheme config (see class_scheme.py)
+scheme = load_scheme()
 
 for basin in basins:
     # Read and reclassify
     df = pd.read_excel(result_log, sheet_name=basin)
-    df['reclassified'] = "Other"
-    df.loc[df['Class_Code'].isin(ag), 'reclassified'] = "Agriculture"
-    df.loc[df['Class_Code'].isin(urban), 'reclassified'] = "Urban"
-    df.loc[df['Class_Code'].isin(good), 'reclassified'] = "Conservation Value"
-    df.loc[df['Class_Code'].isin(forest), 'reclassified'] = "Forest"
-    df.loc[df['Class_Code'].isin(water_values), 'reclassified'] = "Water"
+    df['reclassified'] = scheme.reclassify(df['Class_Code'])
 
     # Process data
     base_year = 1996
@@ -88,3 +85,26 @@ for basin in basins:
     plt.tight_layout()
     plt.savefig(f"{output_dir}/{basin}_PercentChange_Heatmap.png", dpi=300)
     plt.show()
+
+    # 5. Transition Heatmaps (base year -> last year, whole basin and within the flow mask)
+    if not os.path.exists(transition_log):
+        continue
+    transitions = pd.read_excel(transition_log, sheet_name=basin)
+    last_year = max(year_columns)
+    for restriction, title in [("All", "Basin"), ("FlowMask200m", "Within 200 m of Streams")]:
+        df_t = transitions[(transitions['Restriction'] == restriction) &
+                           (transitions['From_Year'] == base_year) & (transitions['To_Year'] == last_year)].copy()
+        if df_t.empty:
+            continue
+        df_t['From'] = scheme.reclassify(df_t['From_Code'])
+        df_t['To'] = scheme.reclassify(df_t['To_Code'])
+        matrix = df_t.pivot_table(index='From', columns='To', values='Area_ha', aggfunc='sum', fill_value=0)
+
+        plt.figure(figsize=(10, 8))
+        sns.heatmap(matrix, annot=True, fmt='.0f', cmap='YlOrRd', cbar_kws={'label': 'Area (ha)'})
+        plt.title(f'Land Use Transitions {base_year} to {last_year} ({title})', fontsize=14, fontweight='bold')
+        plt.xlabel(f'Land Use Category {last_year}')
+        plt.ylabel(f'Land Use Category {base_year}')
+        plt.tight_layout()
+        plt.savefig(f"{output_dir}/{basin}_Transitions_{restriction}_Heatmap.png", dpi=300)
+        plt.show()
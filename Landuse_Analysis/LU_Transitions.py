@@ -0,0 +1,75 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from class_scheme import load_scheme
+from raster_stats import transition_matrices
+from LU_Change_Summary import landuse_raster, pixel_area_ha, no_data
+
+# Class-to-class land cover transitions (what became what) of every consecutive year pair and of the base year to
+# every later year, for the whole basin and within the 200 m flow mask. All years of a basin are read together block
+# by block (raster_stats.transition_matrices), basins and restrictions in parallel. The table is in long form, one row
+# per from -> to class pair with a non-zero area; LU_Change_Visualiser.py plots it.
+
+basins = ["WestDelaware", "ElkCreek", "TownBrooke"]
+years = [1996, 2001, 2006, 2010, 2016, 2021]
+base_year = 1996
+workers = None  # processes; None = one per core
+
+class_names = load_scheme().class_names
+
+transition_log=fr"D:\Ashok\Catskills_Project\Inputs\Landuse\Subbasin_Transitions_Log.xlsx"
+
+
+def flow_mask_file(basin, year):
+    return fr"D:\Ashok\Catskills_Project\Inputs\{basin}\{basin}_{year}_Flow_Mask_200m.tif"
+
+
+def year_pairs():
+    # consecutive years, then the base year to every later year (without repeating the first consecutive pair)
+    b = years.index(base_year)
+    pairs = list(zip(range(len(years) - 1), range(1, len(years))))
+    pairs += [(b, j) for j in range(b + 1, len(years)) if (b, j) not in pairs]
+    return pairs
+
+
+def basin_transitions(basin, restriction):
+    paths = [landuse_raster(basin, year) for year in years]
+    mask = flow_mask_file(basin, base_year) if restriction == "FlowMask200m" else None
+    matrices = transition_matrices(paths, year_pairs(), mask, no_data)
+
+    rows = []
+    for (i, j), counts in matrices.items():
+        for from_code, to_code in zip(*np.nonzero(counts)):
+            rows.append({
+                'Restriction': restriction,
+                'From_Year': years[i],
+                'To_Year': years[j],
+                'From_Code': int(from_code),
+                'To_Code': int(to_code),
+                'From_Class': class_names.get(int(from_code), f"Class {from_code}"),
+                'To_Class': class_names.get(int(to_code), f"Class {to_code}"),
+                'Area_ha': counts[from_code, to_code] * pixel_area_ha,
+                })
+    return pd.DataFrame(rows)
+
+
+def main():
+    restrictions = ["All", "FlowMask200m"]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {(basin, r): pool.submit(basin_transitions, basin, r) for basin in basins for r in restrictions}
+
+    with pd.ExcelWriter(transition_log) as writer:
+        for basin in basins:
+            df = pd.concat([futures[(basin, r)].result() for r in restrictions], ignore_index=True)
+            df.to_excel(writer, sheet_name=basin, index=False)
+            print(f" Wrote transitions for {basin}")
+
+    print(f"\n Transitions saved to: {transition_log}")
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,71 @@
+from osgeo import gdal
+import itertools
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from job_scheduler import run_jobs, report_jobs
+
+gdal.UseExceptions()
+
+# Land cover of every basin-year: clip to the basin, Albers -> UTM 18N and nearest-neighbour 10 m resampling in one
+# warped VRT per basin-year. The VRT is a small XML file; GDAL warps only the blocks that are actually read, so
+# the 30 m clip and the 10 m copy are never written. materialize=True also writes the 10 m GeoTIFF (for the arcpy
+# steps), all years in parallel.
+#
+# Unlike ProjectRaster, GDAL picks the NAD83 -> WGS84 transformation itself (PROJ's default) instead of
+# WGS_1984_(ITRF00)_To_NAD_1983; pass another one with coordinate_operation if the cells must match the old rasters.
+
+years=[1996, 2001, 2006, 2010, 2016, 2021]
+basins=["Cannonsville"]
+out_crs='EPSG:32618'
+cell_size=10
+nodata=999
+coordinate_operation=None       # e.g. a PROJ pipeline string; None = PROJ's default
+materialize=False
+workers=None                    # processes for materialize; None = one per core
+
+creation_options=['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=IF_SAFER']
+
+
+def landuse_vrt(basin, year):
+    return fr"D:\Ashok\Catskills_Project\Inputs\Landuse\{basin}\{basin}_{year}_ccap_LC_Resampled10m.vrt"
+
+
+def build_vrt(basin, year):
+    landuse_raster=fr"D:\Ashok\Catskills_Project\Inputs\Landuse\CONUS\conus_{year}_ccap_landcover_20200311.tif"
+    wshed_shp=fr"D:\Ashok\Catskills_Project\Inputs\Subbasin_Boundaries\{basin}_boundary.shp"
+    out_vrt=landuse_vrt(basin, year)
+    os.makedirs(os.path.dirname(out_vrt), exist_ok=True)
+
+    # targetAlignedPixels puts every year on the same 10 m grid
+    options = dict(format='VRT', dstSRS=out_crs, xRes=cell_size, yRes=cell_size, targetAlignedPixels=True,
+                   resampleAlg='near', cutlineDSName=wshed_shp, cropToCutline=True, dstNodata=nodata,
+                   outputType=gdal.GDT_UInt16)
+    if coordinate_operation:
+        options['coordinateOperation'] = coordinate_operation
+    ds = gdal.Warp(out_vrt, landuse_raster, **options)
+    del ds
+    print(f"Warped VRT saved to :{out_vrt}")
+    return out_vrt
+
+
+def write_tif(basin, year):
+    # The 10 m GeoTIFF (the file the arcpy steps read), read block by block from the VRT
+    out_raster=fr"D:\Ashok\Catskills_Project\Inputs\Landuse\{basin}\{basin}_{year}_ccap_LC_Resampled10m.tif"
+    ds = gdal.Translate(out_raster, landuse_vrt(basin, year), creationOptions=creation_options)
+    del ds
+    print(f"Resampled raster {basin}_{year}")
+
+
+def main():
+    for year, basin in itertools.product(years, basins):
+        build_vrt(basin, year)
+
+    if materialize:
+        jobs = [(f"{basin}-{year}", write_tif, (basin, year)) for year, basin in itertools.product(years, basins)]
+        report_jobs(run_jobs(jobs, workers))
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,7 @@
+# Benchmarks of the traversal engines on synthetic inputs
+#
+# synthetic.py generates inputs that look like the real ones (D8 flow direction from a random DEM, C-CAP-like land
+# cover with the streams burnt in as water, a 200 m flow mask around the streams) at any size, and run.py times every
+# engine on them and checks that each one gives exactly the outputs of the recursive reference walk.
+#
+# Run with `python -m benchmark` from the repository folder; the sizes and engines are set in benchmark/run.py main().
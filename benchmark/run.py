@@ -0,0 +1,153 @@
+# Times the traversal engines on synthetic inputs and checks them against the recursive reference
+#
+# Every (engine, size) run happens in a fresh worker process that generates its own inputs from the seed, so the
+# peak memory of one run doesn't carry over into the next. Peak RSS is reported for the whole worker (inputs
+# included) and as the increase over the RSS after the inputs were generated.
+#
+# The equivalence check runs every engine in this process on check_size x check_size grids and compares all output
+# rasters with traverse_recursive, the original sequencer/move_on walk.
+
+import os
+import sys
+import time
+import itertools
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import traversability_numpy as tn
+from run_metrics import peak_rss_mb, append_csv
+from benchmark.synthetic import make_inputs
+
+results_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_results.csv")
+
+
+def run_recursive(lc, fdr, dist_mask, fdr_no_data):
+    return tn.traverse_recursive(lc, fdr, dist_mask, fdr_no_data)
+
+
+def run_vectorized(lc, fdr, dist_mask, fdr_no_data):
+    return tn.traverse(lc, fdr, dist_mask, fdr_no_data, 'vectorized')
+
+
+def run_compact(lc, fdr, dist_mask, fdr_no_data):
+    return tn.traverse(*tn.compact_inputs(lc, fdr, dist_mask, fdr_no_data), 'vectorized', compact=True)
+
+
+def run_numba(lc, fdr, dist_mask, fdr_no_data):
+    return tn.traverse(lc, fdr, dist_mask, fdr_no_data, 'numba')
+
+
+def run_tiled(lc, fdr, dist_mask, fdr_no_data, workers=None, tile_size=1024):
+    return tn.traverse_tiled(lc, fdr, dist_mask, fdr_no_data, workers, tile_size)
+
+
+def run_streaming(lc, fdr, dist_mask, fdr_no_data, memory_limit_mb=256, band_rows=None):
+    # band_rows overrides the band height that memory_limit_mb gives
+    def read_window(row, rows):
+        return lc[row:row + rows], fdr[row:row + rows], dist_mask[row:row + rows]
+
+    outputs = tn.empty_outputs(lc.shape)
+    if band_rows is None:
+        band_rows = tn.band_height(lc.shape[1], memory_limit_mb)
+    for o, row, block in tn.traverse_bands(read_window, lc.shape, fdr_no_data, band_rows):
+        outputs[o][row:row + block.shape[0]] = block
+    return outputs
+
+
+engines = {
+    'recursive': run_recursive,
+    'vectorized': run_vectorized,
+    'compact': run_compact,
+    'numba': run_numba,
+    'tiled': run_tiled,
+    'streaming': run_streaming,
+    }
+
+
+def timed_run(engine, size, seed):
+    # Worker: generate the inputs, run one engine, report its time and memory
+    if engine == 'numba':
+        # compile first, so the timing doesn't include the JIT
+        engines[engine](*make_inputs(50, seed))
+    lc, fdr, dist_mask, fdr_no_data = make_inputs(size, seed)
+    n_start = int(np.count_nonzero(tn.start_cells(lc, fdr, dist_mask, fdr_no_data)))
+    base = peak_rss_mb()
+    start = time.perf_counter()
+    engines[engine](lc, fdr, dist_mask, fdr_no_data)
+    seconds = time.perf_counter() - start
+    peak = peak_rss_mb()
+    return {
+        'engine': engine,
+        'size': size,
+        'seed': seed,
+        'cells': lc.size,
+        'start_cells': n_start,
+        'seconds': round(seconds, 3),
+        'cells_per_second': round(lc.size / seconds, 1),
+        'start_cells_per_second': round(n_start / seconds, 1),
+        'peak_rss_mb': peak,
+        'run_rss_mb': None if peak is None or base is None else round(peak - base, 1),
+        }
+
+
+def benchmark(engine_names, sizes, seed=0, max_recursive_cells=2000**2):
+    # Times every engine at every size. The recursive walk is only timed up to max_recursive_cells
+    records = []
+    for size, engine in itertools.product(sizes, engine_names):
+        if engine == 'recursive' and size * size > max_recursive_cells:
+            continue
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            try:
+                record = pool.submit(timed_run, engine, size, seed).result()
+            except Exception as e:
+                print(f"{engine} at {size}x{size} failed: {e}")
+                continue
+        print(f"{engine:<12} {size:>6}x{size:<6} {record['seconds']:>10.2f} s {record['cells_per_second']:>14,.0f} cells/s"
+              f" {record['peak_rss_mb'] or float('nan'):>10.0f} MB peak")
+        append_csv(record, results_file)
+        records.append(record)
+    return records
+
+
+def same_outputs(a, b):
+    # Names of the output rasters that differ (compact outputs are expanded first)
+    return [o for o in tn.output_names if not np.array_equal(tn.output_array(a, o), tn.output_array(b, o))]
+
+
+def check_equivalence(engine_names, check_size=300, seeds=(0, 1, 2)):
+    # Every engine against traverse_recursive on small synthetic grids. Returns the list of failures
+    failures = []
+    for seed in seeds:
+        lc, fdr, dist_mask, fdr_no_data = make_inputs(check_size, seed)
+        reference = run_recursive(lc, fdr, dist_mask, fdr_no_data)
+        for engine in engine_names:
+            if engine == 'recursive':
+                continue
+            if engine == 'tiled':
+                outputs = run_tiled(lc, fdr, dist_mask, fdr_no_data, workers=2, tile_size=check_size // 3 + 1)
+            elif engine == 'streaming':
+                # several bands, so the halos and the carried-over buffwidmax/buildup rows are exercised
+                outputs = run_streaming(lc, fdr, dist_mask, fdr_no_data, band_rows=check_size // 4 + 1)
+            else:
+                outputs = engines[engine](lc, fdr, dist_mask, fdr_no_data)
+            differ = same_outputs(reference, outputs)
+            print(f"seed {seed} {engine:<12} {'identical' if not differ else 'DIFFERS in ' + ', '.join(differ)}")
+            if differ:
+                failures.append((seed, engine, differ))
+    return failures
+
+
+def main():
+    engine_names = ['recursive', 'vectorized', 'compact', 'numba', 'tiled', 'streaming']
+    sizes = [1000, 2000, 5000, 10000, 20000]
+    check_size = 300
+
+    failures = check_equivalence(engine_names, check_size)
+    print(f"\nEquivalence check: {'all engines identical to the recursive walk' if not failures else f'{len(failures)} failures'}\n")
+    benchmark(engine_names, sizes)
+    print(f"\nResults appended to {results_file}")
+
+
+if __name__ == '__main__':
+    main()
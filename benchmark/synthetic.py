@@ -0,0 +1,180 @@
+# Synthetic traversal inputs
+#
+# make_inputs(size, seed) returns (lc, fdr, dist_mask, fdr_no_data) for a size x size grid, built like the real inputs:
+#   - a random DEM (a few octaves of smooth noise on a regional slope) and its D8 flow direction (1..128, edge cells
+#     flow off the map, pits flow to their lowest neighbour, so small cycles occur as they do in the real FDR)
+#   - streams traced down the flow directions from random sources, burnt into the land cover as water (21)
+#   - C-CAP-like land cover: patches of forest, pasture, crops, development, grassland, shrub and wetland in roughly
+#     the proportions of the Catskills basins, plus a few ponds
+#   - a basin outline: cells outside it are NODATA in the land cover (999) and the flow direction (255)
+#   - the flow mask: cells within mask_radius cells (200 m at 10 m) of a stream
+# Everything is generated in row blocks where it matters, so 20k x 20k grids stay within a few GB.
+
+import os
+import sys
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from raster_grid import offsets
+from traversability_numpy import next_cell_index
+
+try:
+    from scipy import ndimage
+except ImportError:
+    ndimage = None
+
+fdr_no_data = 255
+lc_no_data = 999
+mask_radius = 20
+block_rows = 2048
+
+# C-CAP classes of the land cover patches and their share of the basin
+land_cover_shares = [
+    (9, 0.30),      # deciduous forest
+    (11, 0.15),     # mixed forest
+    (10, 0.08),     # evergreen forest
+    (7, 0.16),      # pasture/hay
+    (6, 0.05),      # cultivated
+    (8, 0.06),      # grassland
+    (12, 0.05),     # scrub/shrub
+    (13, 0.03),     # palustrine forested wetland
+    (15, 0.02),     # palustrine emergent wetland
+    (5, 0.04),      # developed open space
+    (4, 0.03),      # low intensity developed
+    (3, 0.02),      # medium intensity developed
+    (2, 0.01),      # high intensity developed
+    ]
+stream_value = 21
+pond_value = 23
+
+
+def smooth_noise(shape, cell, rng):
+    # Noise with features about `cell` pixels across: a coarse random grid, bilinearly interpolated (float32)
+    length, width = shape
+    coarse = rng.random((length // cell + 2, width // cell + 2)).astype(np.float32)
+    rows = np.arange(length, dtype=np.float32) / cell
+    cols = np.arange(width, dtype=np.float32) / cell
+    r0 = rows.astype(np.int64)
+    c0 = cols.astype(np.int64)
+    fr = (rows - r0)[:, None]
+    fc = (cols - c0)[None, :]
+    out = np.empty(shape, dtype=np.float32)
+    for b in range(0, length, block_rows):
+        r = slice(b, b + block_rows)
+        top = coarse[r0[r]][:, c0] * (1 - fc) + coarse[r0[r]][:, c0 + 1] * fc
+        bottom = coarse[r0[r] + 1][:, c0] * (1 - fc) + coarse[r0[r] + 1][:, c0 + 1] * fc
+        out[r] = top * (1 - fr[r]) + bottom * fr[r]
+    return out
+
+
+def random_dem(size, rng):
+    # Elevation in metres: octaves of smooth noise on a slope falling towards the south-west
+    shape = (size, size)
+    dem = np.zeros(shape, dtype=np.float32)
+    for cell, relief in [(max(size // 4, 2), 300.0), (64, 40.0), (16, 8.0), (4, 1.0)]:
+        dem += relief * smooth_noise(shape, min(cell, size), rng)
+    dem += np.linspace(0, 200, size, dtype=np.float32)[::-1][:, None] * 0.5
+    dem += np.linspace(0, 200, size, dtype=np.float32)[None, :] * 0.5
+    return dem
+
+
+def d8_directions(dem):
+    # Steepest descent direction of every cell (1..128). Off-map neighbours are lower than anything on the map, so
+    # edge cells can flow off it; a cell without a lower neighbour points at its lowest one
+    length, width = dem.shape
+    fdr = np.zeros(dem.shape, dtype=np.uint8)
+    outside = dem.min() - 1
+    for b in range(0, length, block_rows):
+        e = min(b + block_rows, length)
+        padded = np.full((e - b + 2, width + 2), outside, dtype=np.float32)
+        lo, hi = max(b - 1, 0), min(e + 1, length)
+        padded[lo - b + 1:hi - b + 1, 1:-1] = dem[lo:hi]
+        centre = padded[1:-1, 1:-1]
+        best = np.full(centre.shape, -np.inf, dtype=np.float32)
+        for k, (dv, dh) in offsets.items():
+            drop = (centre - padded[1 + dv:1 + dv + e - b, 1 + dh:1 + dh + width]) / np.float32(np.hypot(dv, dh))
+            steeper = drop > best
+            best[steeper] = drop[steeper]
+            fdr[b:e][steeper] = k
+    return fdr
+
+
+def basin_outline(size, rng):
+    # Irregular basin: an ellipse with a noisy edge
+    rows = np.linspace(-1, 1, size, dtype=np.float32)[:, None]
+    cols = np.linspace(-1, 1, size, dtype=np.float32)[None, :]
+    radius = rows ** 2 / 0.9 + cols ** 2 / 0.95
+    return radius + 0.15 * smooth_noise((size, size), max(size // 8, 2), rng) < 1.0
+
+
+def trace_streams(fdr, inside, rng, density=2e-4, length=None):
+    # Streams: the downstream paths of random source cells inside the basin
+    size = fdr.shape[0]
+    length = length or size
+    nxt = next_cell_index(fdr)
+    n = fdr.size
+    candidates = np.flatnonzero(inside.ravel())
+    pos = rng.choice(candidates, size=max(int(candidates.size * density), 1), replace=False)
+    streams = np.zeros(n + 1, dtype=bool)
+    for _ in range(length):
+        # a source that joins an existing stream (or leaves the map, index n) is done
+        pos = pos[~streams[pos]]
+        if pos.size == 0:
+            break
+        streams[pos] = True
+        pos = np.unique(nxt[pos])
+    streams[n] = False
+    return streams[:n].reshape(fdr.shape)
+
+
+def land_cover(shape, streams, inside, rng):
+    # C-CAP-like land cover: patches from smooth noise, split by land_cover_shares, then ponds and the streams
+    codes = np.array([c for c, _ in land_cover_shares], dtype=np.uint16)
+    shares = np.array([s for _, s in land_cover_shares])
+    patch = smooth_noise(shape, 24, rng) + 0.3 * smooth_noise(shape, 6, rng)
+    edges = np.quantile(patch[::max(shape[0] // 500, 1), ::max(shape[1] // 500, 1)], np.cumsum(shares)[:-1] / shares.sum())
+
+    lc = np.empty(shape, dtype=np.uint16)
+    for b in range(0, shape[0], block_rows):
+        lc[b:b + block_rows] = codes[np.digitize(patch[b:b + block_rows], edges)]
+    del patch
+
+    ponds = smooth_noise(shape, 12, rng) > 0.97
+    lc[ponds] = pond_value
+    lc[streams] = stream_value
+    lc[~inside] = lc_no_data
+    return lc
+
+
+def flow_mask(streams, radius=mask_radius):
+    # Cells within radius cells of a stream (Euclidean distance with scipy, else a diamond/square alternating dilation)
+    if ndimage is not None:
+        return (ndimage.distance_transform_edt(~streams) <= radius).astype(np.uint8)
+    mask = streams.copy()
+    for i in range(radius):
+        grown = mask.copy()
+        grown[1:] |= mask[:-1]
+        grown[:-1] |= mask[1:]
+        grown[:, 1:] |= mask[:, :-1]
+        grown[:, :-1] |= mask[:, 1:]
+        if i % 2:
+            grown[1:, 1:] |= mask[:-1, :-1]
+            grown[1:, :-1] |= mask[:-1, 1:]
+            grown[:-1, 1:] |= mask[1:, :-1]
+            grown[:-1, :-1] |= mask[1:, 1:]
+        mask = grown
+    return mask.astype(np.uint8)
+
+
+def make_inputs(size, seed=0):
+    # (lc, fdr, dist_mask, fdr_no_data) of a synthetic size x size basin
+    rng = np.random.default_rng(seed)
+    dem = random_dem(size, rng)
+    fdr = d8_directions(dem)
+    del dem
+    inside = basin_outline(size, rng)
+    streams = trace_streams(fdr, inside, rng) & inside
+    lc = land_cover(fdr.shape, streams, inside, rng)
+    dist_mask = flow_mask(streams)
+    fdr[~inside] = fdr_no_data
+    return lc, fdr, dist_mask, fdr_no_data
@@ -0,0 +1,82 @@
+# Land cover class scheme shared by the traversal and the land-use analysis scripts
+#
+# The class groups (ag, urban, good, forest, water) used to be Python lists repeated in every script. They now live in one
+# JSON config (class_schemes/ccap.json by default) and are compiled into a 256-entry uint8 bit-flag table, so class tests
+# become array lookups: scheme.flags_of(lc) & WATER instead of "c in water_values".
+#
+# To use another classification scheme, write a config with the same keys and point the LULC_CLASS_SCHEME environment
+# variable at it.
+
+import os
+import json
+import numpy as np
+
+default_scheme_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "class_schemes", "ccap.json")
+
+# Bit flags of the class groups
+AG = 1
+URBAN = 2
+GOOD = 4
+FOREST = 8
+WATER = 16
+group_flags = {'ag': AG, 'urban': URBAN, 'good': GOOD, 'forest': FOREST, 'water': WATER}
+
+
+class ClassScheme:
+    def __init__(self, name, class_names, groups, categories):
+        self.name = name
+        self.class_names = class_names      # {code: name}
+        self.groups = groups                # {'ag': [codes], ...}
+        self.categories = categories        # [(label, group)], later entries win when a class is in several groups
+
+        self.flags = np.zeros(256, dtype=np.uint8)
+        for group, codes in groups.items():
+            if group not in group_flags:
+                raise ValueError(f"Unknown class group '{group}' in scheme {name}, expected one of {list(group_flags)}")
+            for code in codes:
+                if not 0 <= code < 256:
+                    raise ValueError(f"Class code {code} of group '{group}' in scheme {name} is outside 0-255")
+                self.flags[code] |= group_flags[group]
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path) as f:
+            config = json.load(f)
+        return cls(
+            config['name'],
+            {int(code): name for code, name in config.get('classes', {}).items()},
+            {group: [int(c) for c in codes] for group, codes in config['groups'].items()},
+            [tuple(c) for c in config.get('categories', [])],
+            )
+
+    def values(self, group):
+        return list(self.groups.get(group, []))
+
+    def flags_of(self, lc):
+        # Flags of every value in lc. Values outside 0-255 (e.g. the 999 NODATA) have no flags
+        lc = np.asarray(lc)
+        if lc.dtype == np.uint8:
+            return self.flags[lc]
+        inside = (lc >= 0) & (lc < 256)
+        return np.where(inside, self.flags[np.where(inside, lc, 0).astype(np.intp)], 0).astype(np.uint8)
+
+    def removal_rates(self, rate_forest, rate_nonforest):
+        # Per-class removal rate: rate_forest for forest classes, rate_nonforest for the other 'good' classes, 0 otherwise
+        rates = np.zeros(256)
+        rates[(self.flags & GOOD) > 0] = rate_nonforest
+        rates[(self.flags & (GOOD | FOREST)) == (GOOD | FOREST)] = rate_forest
+        return rates
+
+    def reclassify(self, codes, other="Other"):
+        # Category label of each class code (NaN and unknown codes get `other`)
+        codes = np.asarray(codes, dtype=np.float64)
+        valid = np.isfinite(codes) & (codes >= 0) & (codes < 256)
+        flags = np.where(valid, self.flags[np.where(valid, codes, 0).astype(np.intp)], 0)
+        labels = np.full(codes.shape, other, dtype=object)
+        for label, group in self.categories:
+            labels[(flags & group_flags[group]) > 0] = label
+        return labels
+
+
+def load_scheme(path=None):
+    return ClassScheme.from_file(path or os.environ.get('LULC_CLASS_SCHEME', default_scheme_file))
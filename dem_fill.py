@@ -0,0 +1,257 @@
+# Depression filling of the DEM (replaces arcpy.sa.Fill)
+#
+# fill_depressions is the Priority-Flood of Barnes et al. (2014): the cells on the edge of the raster or next to NODATA
+# are the outlets; cells are taken from a priority queue lowest first, and a neighbour that is no higher than the
+# current cell is raised to its level and put on a plain FIFO queue instead, which is emptied first. Flats and filled
+# depressions therefore cost O(1) per cell and only the rest of the DEM goes through the heap. Every sink is raised to
+# its spill elevation with no z limit, as Fill does with z_limit=None.
+#
+# fill_tiled gives the same result for DEMs larger than memory, following Barnes (2016). Each tile is flooded on its
+# own from its perimeter, with every perimeter cell labelling the cells it reaches. The spill elevations between the
+# labels (inside tiles and across tile edges) form a small graph that is solved for the lowest level at which each
+# label drains off the raster. A second pass floods each tile again and raises every cell to its label's level. Only
+# one tile plus the tile perimeters are in memory at a time.
+#
+# The flood loop is compiled with numba when it is installed, and runs as plain Python otherwise.
+
+import heapq
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+ocean = 1       # label of the cells that drain off the raster or into NODATA
+
+neighbours_v = np.array([-1, -1, -1, 0, 0, 1, 1, 1])
+neighbours_h = np.array([-1, 0, 1, -1, 1, -1, 0, 1])
+
+
+def flood(filled, nodata, labels):
+    # Priority-Flood in place. labels > 0 marks the seed cells (and their label); the other cells get the label of the
+    # cell that flooded them. filled is raised to the spill elevation of every depression
+    length, width = filled.shape
+    closed = nodata.copy()
+    heap = [(0.0, 0)]
+    heap.pop()
+    for i in range(length):
+        for j in range(width):
+            if labels[i, j] > 0 and not closed[i, j]:
+                closed[i, j] = True
+                heapq.heappush(heap, (np.float64(filled[i, j]), i * width + j))
+
+    pit = [0]
+    pit.pop()
+    head = 0
+    while heap or head < len(pit):
+        if head < len(pit):
+            cell = pit[head]
+            head += 1
+            if head == len(pit):
+                pit.clear()
+                head = 0
+        else:
+            cell = heapq.heappop(heap)[1]
+        i = cell // width
+        j = cell % width
+        for k in range(8):
+            v = i + neighbours_v[k]
+            h = j + neighbours_h[k]
+            if v < 0 or v >= length or h < 0 or h >= width or closed[v, h]:
+                continue
+            closed[v, h] = True
+            labels[v, h] = labels[i, j]
+            if filled[v, h] <= filled[i, j]:
+                filled[v, h] = filled[i, j]
+                pit.append(v * width + h)
+            else:
+                heapq.heappush(heap, (np.float64(filled[v, h]), v * width + h))
+
+
+if njit is not None:
+    flood = njit(cache=True)(flood)
+
+
+def no_data_mask(dem, no_data):
+    mask = np.isnan(dem) if np.issubdtype(dem.dtype, np.floating) else np.zeros(dem.shape, dtype=bool)
+    if no_data is not None:
+        mask |= dem == no_data
+    return mask
+
+
+def next_to(mask):
+    # Cells with a masked cell among their 8 neighbours
+    padded = np.pad(mask, 1)
+    near = np.zeros(mask.shape, dtype=bool)
+    for dv, dh in zip(neighbours_v, neighbours_h):
+        near |= padded[1 + dv:1 + dv + mask.shape[0], 1 + dh:1 + dh + mask.shape[1]]
+    return near
+
+
+def fill_depressions(dem, no_data=None):
+    # Filled copy of dem. NODATA cells (no_data or NaN) keep their value
+    nodata = no_data_mask(dem, no_data)
+    labels = next_to(nodata).astype(np.int32)
+    labels[[0, -1], :] = ocean
+    labels[:, [0, -1]] = ocean
+    filled = dem.copy()
+    flood(filled, nodata, labels)
+    return filled
+
+
+def tile_windows(shape, tile_size):
+    length, width = shape
+    return [(r, c, min(tile_size, length - r), min(tile_size, width - c))
+            for r in range(0, length, tile_size) for c in range(0, width, tile_size)]
+
+
+def flood_tile(read_window, shape, window, no_data, first_label):
+    # Floods one tile from its perimeter. Perimeter cells get labels first_label, first_label+1, ... (row by row),
+    # except the ones on the raster's edge or next to NODATA, which drain directly and get the ocean label
+    length, width = shape
+    row, col, rows, cols = window
+    # one cell of halo, only to see NODATA in the neighbouring tiles
+    r0, c0 = max(row - 1, 0), max(col - 1, 0)
+    r1, c1 = min(row + rows + 1, length), min(col + cols + 1, width)
+    dem = np.asarray(read_window(r0, c0, r1 - r0, c1 - c0))
+    core = (slice(row - r0, row - r0 + rows), slice(col - c0, col - c0 + cols))
+    nodata = no_data_mask(dem, no_data)
+    drains = next_to(nodata)[core]
+    filled = dem[core].copy()
+    nodata = nodata[core]
+
+    perimeter = np.zeros((rows, cols), dtype=bool)
+    perimeter[[0, -1], :] = True
+    perimeter[:, [0, -1]] = True
+    labels = np.zeros((rows, cols), dtype=np.int32)
+    n_perimeter = int(perimeter.sum())
+    labels[perimeter] = np.arange(first_label, first_label + n_perimeter)
+    if row == 0:
+        drains[0] = True
+    if row + rows == length:
+        drains[-1] = True
+    if col == 0:
+        drains[:, 0] = True
+    if col + cols == width:
+        drains[:, -1] = True
+    labels[drains & ~nodata] = ocean
+    flood(filled, nodata, labels)
+    labels[nodata] = 0
+    return filled, labels, n_perimeter
+
+
+def pair_edges(la, ea, lb, eb):
+    # Spill edges between neighbouring cells with different labels: (label a, label b, max of their elevations)
+    keep = (la > 0) & (lb > 0) & (la != lb)
+    return la[keep], lb[keep], np.maximum(ea[keep], eb[keep]).astype(np.float64)
+
+
+def reduce_edges(edges):
+    # One spill edge per pair of labels, at the lowest level of the edges between them (the only one the minimax search
+    # can take), so the graph grows with the number of labels instead of the number of cells along their borders
+    a = np.concatenate([e[0] for e in edges]) if edges else np.zeros(0, dtype=np.int32)
+    b = np.concatenate([e[1] for e in edges]) if edges else np.zeros(0, dtype=np.int32)
+    w = np.concatenate([e[2] for e in edges]) if edges else np.zeros(0)
+    lo, hi = np.minimum(a, b), np.maximum(a, b)
+    order = np.lexsort((w, hi, lo))
+    lo, hi, w = lo[order], hi[order], w[order]
+    first = np.ones(lo.size, dtype=bool)
+    first[1:] = (lo[1:] != lo[:-1]) | (hi[1:] != hi[:-1])
+    return lo[first], hi[first], w[first]
+
+
+def tile_edges(filled, labels):
+    # Spill edges between the labels inside one tile (8-connected), reduced to one per pair of labels
+    edges = []
+    for (a, b) in [((slice(None), slice(None, -1)), (slice(None), slice(1, None))),
+                   ((slice(None, -1), slice(None)), (slice(1, None), slice(None))),
+                   ((slice(None, -1), slice(None, -1)), (slice(1, None), slice(1, None))),
+                   ((slice(None, -1), slice(1, None)), (slice(1, None), slice(None, -1)))]:
+        edges.append(pair_edges(labels[a], filled[a], labels[b], filled[b]))
+    return reduce_edges(edges)
+
+
+def ring_edges(rings, tiles, tile_size):
+    # Spill edges across tile edges, from the outer rows and columns of neighbouring tiles, reduced to one per pair of
+    # labels
+    edges = []
+    for (row, col, rows, cols) in tiles:
+        filled, labels = rings[(row, col)]
+        for other, side, other_side in [((row, col + tile_size), 'right', 'left'),
+                                        ((row + tile_size, col), 'bottom', 'top')]:
+            if other not in rings:
+                continue
+            f, l = rings[other]
+            a, ea, b, eb = labels[side], filled[side], l[other_side], f[other_side]
+            edges.append(pair_edges(a, ea, b, eb))
+            edges.append(pair_edges(a[:-1], ea[:-1], b[1:], eb[1:]))
+            edges.append(pair_edges(a[1:], ea[1:], b[:-1], eb[:-1]))
+        for other, corner, other_corner in [((row + tile_size, col + tile_size), 'bottom_right', 'top_left'),
+                                            ((row + tile_size, col - tile_size), 'bottom_left', 'top_right')]:
+            if other in rings:
+                f, l = rings[other]
+                edges.append(pair_edges(labels[corner], filled[corner], l[other_corner], f[other_corner]))
+    return reduce_edges(edges)
+
+
+def ring(arr):
+    return {
+        'top': arr[0].copy(), 'bottom': arr[-1].copy(), 'left': arr[:, 0].copy(), 'right': arr[:, -1].copy(),
+        'top_left': arr[:1, 0].copy(), 'top_right': arr[:1, -1].copy(),
+        'bottom_left': arr[-1:, 0].copy(), 'bottom_right': arr[-1:, -1].copy(),
+        }
+
+
+def spill_levels(edges, n_labels):
+    # Lowest level at which each label drains to the ocean: the minimax path over the spill edges (Dijkstra)
+    a = np.concatenate([e[0] for e in edges] + [e[1] for e in edges]).astype(np.int64)
+    b = np.concatenate([e[1] for e in edges] + [e[0] for e in edges]).astype(np.int64)
+    w = np.concatenate([e[2] for e in edges] * 2)
+    order = np.lexsort((w, a))
+    a, b, w = a[order], b[order], w[order]
+    starts = np.searchsorted(a, np.arange(n_labels + 1))
+
+    level = np.full(n_labels, np.inf)
+    level[ocean] = -np.inf
+    heap = [(-np.inf, ocean)]
+    while heap:
+        lv, node = heapq.heappop(heap)
+        if lv > level[node]:
+            continue
+        for k in range(starts[node], starts[node + 1]):
+            new = max(lv, w[k])
+            if new < level[b[k]]:
+                level[b[k]] = new
+                heapq.heappush(heap, (new, int(b[k])))
+    return level
+
+
+def fill_tiled(read_window, write_window, shape, tile_size=4096, no_data=None):
+    # fill_depressions for rasters read and written tile by tile: read_window(row, col, rows, cols) returns part of the
+    # DEM, write_window(row, col, arr) stores part of the result. Each tile is read twice
+    tiles = tile_windows(shape, tile_size)
+
+    # pass 1: flood the tiles, keep their perimeters and the spill edges
+    rings = {}
+    first = {}
+    edges = []
+    next_label = ocean + 1
+    for window in tiles:
+        filled, labels, n_perimeter = flood_tile(read_window, shape, window, no_data, next_label)
+        first[window[:2]] = next_label
+        next_label += n_perimeter
+        rings[window[:2]] = (ring(filled), ring(labels))
+        edges.append(tile_edges(filled, labels))
+    edges.append(ring_edges(rings, tiles, tile_size))
+    del rings
+
+    level = spill_levels(edges, next_label)
+
+    # pass 2: flood again and raise every cell to its label's spill level
+    for window in tiles:
+        filled, labels, _ = flood_tile(read_window, shape, window, no_data, first[window[:2]])
+        raise_to = level[labels]
+        raise_cells = (labels > 0) & (raise_to > filled) & np.isfinite(raise_to)
+        filled[raise_cells] = raise_to[raise_cells].astype(filled.dtype)
+        write_window(window[0], window[1], filled)
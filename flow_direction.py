@@ -0,0 +1,157 @@
+# D8 flow direction of the filled DEM (replaces arcpy.sa.FlowDirection)
+#
+# Same encoding as FlowDirection and the traversal (1 E, 2 SE, 4 S, 8 SW, 16 W, 32 NW, 64 N, 128 NE; offsets in
+# raster_grid.py). Every cell points at the neighbour with the steepest drop (drop / distance, diagonals
+# sqrt(2) away), all eight directions compared on shifted arrays at once. As with force_flow="NORMAL", a cell on the
+# edge of the raster or next to NODATA that has no lower neighbour flows off the raster.
+#
+# Unlike FlowDirection, no cell gets a sum of several codes (which the traversal stops on with code 3000):
+#   - equal steepest drops go to the first direction in the order above
+#   - flats (no lower neighbour, but neighbours of the same elevation) drain towards the nearest cell of the flat's
+#     outlet: a breadth-first search from the flat's edge cells that do drain, each flat cell pointing at a neighbour
+#     one step closer to the outlet (again the first in the order above)
+# Cells that can't drain at all (a pit without equal neighbours, which the fill doesn't leave) get 0.
+#
+# flow_directions_tiled reads the DEM in tiles with a one-cell halo. The flat cells of all tiles are resolved together,
+# so the result is identical to flow_directions on the whole grid.
+
+import numpy as np
+from dem_fill import no_data_mask, tile_windows
+from raster_grid import offsets
+
+fdr_no_data = 255
+
+# direction codes in order of preference, and the direction pointing back along each of them
+order = list(offsets)
+opposite = {k: [o for o, (v, h) in offsets.items() if (v, h) == (-dv, -dh)][0] for k, (dv, dh) in offsets.items()}
+
+
+def read_halo(read_window, shape, window, no_data):
+    # A tile plus one cell of halo; cells beyond the raster are NODATA
+    length, width = shape
+    row, col, rows, cols = window
+    r0, c0 = max(row - 1, 0), max(col - 1, 0)
+    r1, c1 = min(row + rows + 1, length), min(col + cols + 1, width)
+    dem = np.zeros((rows + 2, cols + 2))
+    nodata = np.ones((rows + 2, cols + 2), dtype=bool)
+    inner = (slice(r0 - row + 1, r1 - row + 1), slice(c0 - col + 1, c1 - col + 1))
+    block = np.asarray(read_window(r0, c0, r1 - r0, c1 - c0))
+    dem[inner] = block
+    nodata[inner] = no_data_mask(block, no_data)
+    return dem, nodata
+
+
+def d8_tile(read_window, shape, window, no_data):
+    # Steepest descent directions of one tile. Also returns the flat cells (left at 0) and, for each cell, the codes of
+    # its neighbours with the same elevation (OR-ed together)
+    dem, nodata = read_halo(read_window, shape, window, no_data)
+    rows, cols = window[2], window[3]
+    centre = dem[1:-1, 1:-1]
+    best = np.zeros((rows, cols))
+    fdr = np.zeros((rows, cols), dtype=np.uint8)
+    outward = np.zeros((rows, cols), dtype=np.uint8)
+    equal = np.zeros((rows, cols), dtype=np.uint8)
+    for k in order:
+        dv, dh = offsets[k]
+        neighbour = dem[1 + dv:1 + dv + rows, 1 + dh:1 + dh + cols]
+        missing = nodata[1 + dv:1 + dv + rows, 1 + dh:1 + dh + cols]
+        drop = (centre - neighbour) / np.hypot(dv, dh)
+        steeper = ~missing & (drop > best)
+        best[steeper] = drop[steeper]
+        fdr[steeper] = k
+        outward[(outward == 0) & missing] = k
+        equal[~missing & (neighbour == centre)] |= k
+
+    core_nodata = nodata[1:-1, 1:-1]
+    fdr = np.where(fdr == 0, outward, fdr)
+    flat = (fdr == 0) & (equal > 0) & ~core_nodata
+    fdr[core_nodata] = fdr_no_data
+    return fdr, flat, equal
+
+
+def flat_cells(flat, window, width):
+    # Flat index (row-major over the whole raster) of the flat cells of a tile
+    rows, cols = np.nonzero(flat)
+    return (rows + window[0]).astype(np.int64) * width + cols + window[1]
+
+
+def resolve_flats(index, equal, shape):
+    # Directions of the flat cells (index sorted, equal: their same-elevation neighbour codes) by a breadth-first
+    # search from the cells that drain. Returns 0 for flat cells without an outlet
+    length, width = shape
+    n = index.size
+    fdr = np.zeros(n, dtype=np.uint8)
+    if n == 0:
+        return fdr
+
+    def neighbours(cells, k):
+        # positions in index of the k neighbours of cells (-1 when the neighbour isn't a flat cell)
+        dv, dh = offsets[k]
+        nb = index[cells] + dv * width + dh
+        pos = np.minimum(np.searchsorted(index, nb), n - 1)
+        return np.where(index[pos] == nb, pos, -1)
+
+    # first layer: flat cells next to an equal cell that isn't flat, i.e. that drains
+    cells = np.arange(n)
+    for k in order:
+        sel = cells[((equal & k) > 0) & (fdr == 0)]
+        outlet = sel[neighbours(sel, k) < 0]
+        fdr[outlet] = k
+    frontier = np.flatnonzero(fdr)
+
+    while frontier.size:
+        # every unresolved flat neighbour of the frontier points back at it; a cell reached from several frontier cells
+        # takes the first direction in order
+        found = []
+        for k in order:
+            sel = frontier[(equal[frontier] & k) > 0]
+            pos = neighbours(sel, k)
+            pos = pos[pos >= 0]
+            pos = pos[fdr[pos] == 0]
+            found.append(np.stack([pos, np.full(pos.size, order.index(opposite[k]))]))
+        found = np.concatenate(found, axis=1)
+        if found.shape[1] == 0:
+            break
+        found = found[:, np.lexsort((found[1], found[0]))]
+        first = np.r_[True, found[0, 1:] != found[0, :-1]]
+        pos, pref = found[0, first], found[1, first]
+        fdr[pos] = np.array(order, dtype=np.uint8)[pref]
+        frontier = pos
+    return fdr
+
+
+def flow_directions_tiled(read_window, write_window, shape, tile_size=4096, no_data=None):
+    # read_window(row, col, rows, cols) returns part of the filled DEM, write_window(row, col, fdr) stores part of the
+    # flow direction (uint8, 255 on NODATA). Each tile is read twice; only the flat cells are kept in between
+    length, width = shape
+    tiles = tile_windows(shape, tile_size)
+
+    index = []
+    equal = []
+    for window in tiles:
+        _, flat, eq = d8_tile(read_window, shape, window, no_data)
+        index.append(flat_cells(flat, window, width))
+        equal.append(eq[flat])
+    index = np.concatenate(index)
+    equal = np.concatenate(equal)
+    order_cells = np.argsort(index)
+    index, equal = index[order_cells], equal[order_cells]
+    flat_fdr = resolve_flats(index, equal, shape)
+    print(f"Resolved {np.count_nonzero(flat_fdr)} of {index.size} flat cells")
+
+    for window in tiles:
+        fdr, flat, _ = d8_tile(read_window, shape, window, no_data)
+        fdr[flat] = flat_fdr[np.searchsorted(index, flat_cells(flat, window, width))]
+        write_window(window[0], window[1], fdr)
+
+
+def flow_directions(dem, no_data=None):
+    # D8 flow direction of a filled DEM held in memory
+    fdr = np.zeros(dem.shape, dtype=np.uint8)
+
+    def write_window(row, col, arr):
+        fdr[row:row + arr.shape[0], col:col + arr.shape[1]] = arr
+
+    flow_directions_tiled(lambda row, col, rows, cols: dem[row:row + rows, col:col + cols], write_window, dem.shape,
+                          max(dem.shape), no_data)
+    return fdr
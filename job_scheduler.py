@@ -0,0 +1,72 @@
+# Runs independent basin-year jobs concurrently in worker processes
+#
+# Used by the main() of traversability_numpy.py and preprocessing.py. Each job is a (label, function, args) tuple; the
+# function runs in a worker process and its wall time and any exception are reported back instead of only being printed.
+#
+# Large read-only inputs that several jobs need (the basin's FDR raster) can be put in shared memory once with
+# share_array and attached in the workers with attach_array, so they are neither re-read from disk nor pickled per job.
+
+import time
+import traceback
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+import numpy as np
+
+
+def share_array(arr):
+    # Copy arr into a new shared memory block. Returns the block (keep it open, and close/unlink it when the jobs are done)
+    # and the spec that attach_array needs
+    shm = shared_memory.SharedMemory(create=True, size=max(arr.nbytes, 1))
+    shared = np.ndarray(arr.shape, dtype=arr.dtype, buffer=shm.buf)
+    shared[...] = arr
+    del shared
+    return shm, (shm.name, arr.shape, arr.dtype.str)
+
+
+def attach_array(spec):
+    # Read-only view of an array shared with share_array. Delete the array before closing the returned block
+    name, shape, dtype = spec
+    shm = shared_memory.SharedMemory(name=name)
+    arr = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+    arr.flags.writeable = False
+    return shm, arr
+
+
+def timed_call(func, args):
+    start = time.perf_counter()
+    try:
+        func(*args)
+        return 'ok', time.perf_counter() - start, None
+    except Exception:
+        return 'failed', time.perf_counter() - start, traceback.format_exc()
+
+
+def run_jobs(jobs, workers=None):
+    # Runs the jobs in a process pool and returns one {'job', 'status', 'seconds', 'error'} record per job, in job order
+    results = {}
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(timed_call, func, args): label for label, func, args in jobs}
+        for count, future in enumerate(as_completed(futures), 1):
+            label = futures[future]
+            try:
+                status, seconds, error = future.result()
+            except Exception:
+                # the worker process itself died
+                status, seconds, error = 'failed', float('nan'), traceback.format_exc()
+            results[label] = {'job': label, 'status': status, 'seconds': seconds, 'error': error}
+            print(f"{count}/{len(jobs)} {label}: {status} in {seconds:.1f} s")
+    print(f"Total time taken : {time.perf_counter() - start:.1f} s")
+    return [results[label] for label, _, _ in jobs]
+
+
+def report_jobs(results):
+    # Per-job wall time, then the errors of the failed jobs
+    print(f"\n{'Job':<30} {'Status':<8} {'Seconds':>10}")
+    for r in results:
+        print(f"{r['job']:<30} {r['status']:<8} {r['seconds']:>10.1f}")
+    failed = [r for r in results if r['status'] != 'ok']
+    for r in failed:
+        print(f"\n{r['job']} failed:\n{r['error']}")
+    print(f"\n{len(results) - len(failed)} of {len(results)} jobs succeeded")
+    return failed
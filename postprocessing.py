@@ -1,12 +1,9 @@
-import arcpy
 import os
 import csv
-import numpy as np
-from arcpy.sa import Raster
+import itertools
 import matplotlib.pyplot as plt
 import pandas as pd
-
-arcpy.env.overwriteOutput = True
+from raster_stats import raster_histograms
 
 basins = ["WestDelaware", "ElkCreek", "TownBrooke"]
 years = [1996, 2001, 2006, 2010, 2016, 2021]
@@ -14,20 +11,31 @@ input_dir = r"D:\Ashok\Catskills_Project\Outputs"
 output_dir = input_dir
 nodata_val = -999  # Buffwidmax NoData value
 
+# Traversal scenarios to compare, (label, output prefix) - the prefixes of traversability_numpy.scenarios.
+# buildup_count also counts every scenario against the reference scenario's threshold
+scenarios = [("Buffered", "Buffer"), ("NoBuffer", "NoBuffer")]
+reference_scenario = "NoBuffer"
+workers = None  # processes reading the rasters; None = one per core
+
+# The rasters are streamed block by block into integer histograms (raster_stats.py), all rasters of a step in parallel.
+# The value counts, 75th percentiles and exceedance counts come from the histograms and are the same as those of the
+# full arrays
+
 def width_freq():
+    paths = {(basin, year): os.path.join(input_dir, basin, f"Buffer_{basin}_{year}__buffwidmax.tif")
+             for basin, year in itertools.product(basins, years)}
+    hists = raster_histograms(list(paths.values()), nodata_val, workers)  # NoData filtered
+
     for basin in basins:
         result_dict = {}  # {BufferWidth: {Year: Count}}
 
         for year in years:
-            raster_path = os.path.join(input_dir, basin, f"Buffer_{basin}_{year}__buffwidmax.tif")
-            if not arcpy.Exists(raster_path):
+            hist = hists[paths[(basin, year)]]
+            if hist is None:
                 print(f"Missing raster for {basin}-{year}")
                 continue
 
-            arr = arcpy.RasterToNumPyArray(raster_path)
-            arr = arr[arr != nodata_val]  # Filter NoData
-
-            values, counts = np.unique(arr, return_counts=True)
+            values, counts = hist.values_counts()
 
             for val, count in zip(values, counts):
                 if val not in result_dict:
@@ -91,43 +99,42 @@ def maxwidthchange_plot():
 
 
 def buildup_count():
+    # High-buildup cell counts of every traversal scenario. Each scenario is counted against its own 75th percentile
+    # (HighBuildupCount_<label>) and against the reference scenario's 75th percentile (HighBuildupCount_<label>_AtRef),
+    # so the scenarios of one run are compared on the same threshold as well
+
+    paths = {(basin, year, label): os.path.join(input_dir, basin, f"{prefix}_{basin}_{year}__buildup_ag_and_urban.tif")
+             for basin, year, (label, prefix) in itertools.product(basins, years, scenarios)}
+    hists = raster_histograms(list(paths.values()), 999, workers)
 
     for basin in basins:
         data = []
         for year in years:
-            # Buffered path
-            buffer_raster = os.path.join(input_dir, basin, f"Buffer_{basin}_{year}__buildup_ag_and_urban.tif")
-            nobuffer_raster = os.path.join(input_dir, basin, f"NoBuffer_{basin}_{year}__buildup_ag_and_urban.tif")
-
-            # Initialize counts
-            buffer_count = None
-            nobuffer_count = None
+            row = {"Year": year}
 
-            for label, path in [("Buffered", buffer_raster), ("NoBuffer", nobuffer_raster)]:
-                if not arcpy.Exists(path):
+            values = {}
+            for label, prefix in scenarios:
+                path = paths[(basin, year, label)]
+                if hists[path] is None:
                     print(f"Missing: {path}")
+                    row[f"HighBuildupCount_{label}"] = None
                     continue
+                values[label] = hists[path]
 
-                arr = arcpy.RasterToNumPyArray(path).astype(np.float32)
-                arr[arr == 999] = np.nan
-                valid = arr[~np.isnan(arr)]
-
-                if valid.size == 0:
-                    count = 0
+            for label, hist in values.items():
+                if hist.n == 0:
+                    row[f"HighBuildupCount_{label}"] = 0
                 else:
-                    threshold = np.percentile(valid, 75)
-                    count = int(np.sum(valid > threshold))
+                    threshold = hist.quantile(0.75)
+                    row[f"HighBuildupCount_{label}"] = hist.count_above(threshold)
 
-                if label == "Buffered":
-                    buffer_count = count
-                else:
-                    nobuffer_count = count
+            if reference_scenario in values and values[reference_scenario].n > 0:
+                ref_threshold = values[reference_scenario].quantile(0.75)
+                row["RefThreshold"] = ref_threshold
+                for label, hist in values.items():
+                    row[f"HighBuildupCount_{label}_AtRef"] = hist.count_above(ref_threshold)
 
-            data.append({
-                "Year": year,
-                "HighBuildupCount_Buffered": buffer_count,
-                "HighBuildupCount_NoBuffer": nobuffer_count
-            })
+            data.append(row)
 
         # Save to CSV
         df = pd.DataFrame(data)
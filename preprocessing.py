@@ -2,6 +2,9 @@ import arcpy
 from osgeo import gdal
 import itertools
 import os
+import time
+import traceback
+from job_scheduler import run_jobs, report_jobs
 gdal.UseExceptions()
 
 from arcpy.ia import Raster, RasterCalculator
@@ -9,6 +12,7 @@ from arcpy.sa import Raster, Con, IsNull
 arcpy.env.overwriteOutput = True
 
 #Path definitions
+scratch_root=r"D:\Ashok\Catskills_Project\Scratch"
 output_CRS=r'PROJCS["WGS_1984_UTM_Zone_18N",GEOGCS["GCS_WGS_1984",DATUM["D_WGS_1984",SPHEROID["WGS_1984",6378137.0,298.257223563]],PRIMEM["Greenwich",0.0],UNIT["Degree",0.0174532925199433]],PROJECTION["Transverse_Mercator"],PARAMETER["False_Easting",500000.0],PARAMETER["False_Northing",0.0],PARAMETER["Central_Meridian",-75.0],PARAMETER["Scale_Factor",0.9996],PARAMETER["Latitude_Of_Origin",0.0],UNIT["Meter",1.0]]'
 
 def ensure_dir(path):
@@ -19,6 +23,18 @@ def get_shape(path):
     ds = gdal.Open(path)
     return ds.RasterYSize, ds.RasterXSize
 
+def get_grid(path):
+    ds = gdal.Open(path)
+    return ds.RasterYSize, ds.RasterXSize, ds.GetGeoTransform()
+
+def use_scratch(basin, year):
+    # Each worker process gets its own scratch and workspace folder, so the temporary rasters of concurrent
+    # Con/ExtractByMask calls don't collide in (or lock) the default scratch workspace
+    scratch = os.path.join(scratch_root, f"{basin}_{year}_{os.getpid()}")
+    ensure_dir(scratch)
+    arcpy.env.scratchWorkspace = scratch
+    arcpy.env.workspace = scratch
+
 def landuse_processing(basin,year):
     #Landuse
     
@@ -167,28 +183,70 @@ def alignment_check(basin,year):
     print("Mask:", shape_mask)
     assert shape_lulc == shape_fdr == shape_mask, f"Raster shape mismatch for {basin}-{year}"
 
+def check_fdr_inputs(basin, years):
+    # The FDR is built once per basin from years[0]. Its inputs don't depend on the year: the DEM (Mosaiced_Raster.tif)
+    # has no year and the streams aren't burned into it; the land cover only sets the snap grid and extent, so that
+    # must be the same for every year
+    clipped = [fr"D:\Ashok\Catskills_Project\Inputs\Landuse\{basin}\{basin}_{year}_ccap_LC_Resampled10m.tif" for year in years]
+    grids = [get_grid(path) for path in clipped]
+    for year, grid in zip(years[1:], grids[1:]):
+        assert grid == grids[0], f"{basin}-{year} land cover grid {grid} differs from {years[0]}'s {grids[0]}, the FDR can't be shared"
+
+def preprocess_year(basin, year):
+    # Scheduler job: the per-year steps, run after the basin's flow direction raster exists
+    use_scratch(basin, year)
+    landuse_processing(basin, year)
+    flow_mask_processing(basin, year)
+    alignment_check(basin, year)
+
 def main():
     basins = ["Cannonsville"]
     years = [1996, 2001, 2006, 2010, 2016, 2021]
-    total = len(basins) * len(years)
-    count = 0
-
-    for basin, year in itertools.product(basins, years):
-        count += 1
-        print(f"\nProcessing {count}/{total}: {basin}-{year}\n")
+    workers = 1  # 1 = run serially; more (or None = one per core) runs the per-year steps in parallel processes
+
+    if workers == 1:
+        total = len(basins) * len(years)
+        count = 0
+
+        for basin, year in itertools.product(basins, years):
+            count += 1
+            print(f"\nProcessing {count}/{total}: {basin}-{year}\n")
+            try:
+                basin_path = fr"D:\Ashok\Catskills_Project\Inputs\{basin}"
+                ensure_dir(basin_path)
+
+                landuse_processing(basin, year)
+                flow_mask_processing(basin, year)
+                flow_direction_processing(basin, year)
+                alignment_check(basin, year)
+
+            except AssertionError as e:
+                print(f"Alignment error: {e}")
+            except Exception as e:
+                print(f"Unexpected error during {basin}-{year}: {e}")
+        return
+
+    # FDR_10m.tif is the same for every year of a basin, so it is built once per basin (the years would otherwise
+    # all write the same file at the same time), then the years run concurrently
+    results = []
+    jobs = []
+    for basin in basins:
+        basin_path = fr"D:\Ashok\Catskills_Project\Inputs\{basin}"
+        ensure_dir(basin_path)
+        print(f"\nProcessing flow direction: {basin}\n")
+        start = time.perf_counter()
         try:
-            basin_path = fr"D:\Ashok\Catskills_Project\Inputs\{basin}"
-            ensure_dir(basin_path)
-
-            landuse_processing(basin, year)
-            flow_mask_processing(basin, year)
-            flow_direction_processing(basin, year)
-            alignment_check(basin, year)
-
-        except AssertionError as e:
-            print(f"Alignment error: {e}")
-        except Exception as e:
-            print(f"Unexpected error during {basin}-{year}: {e}")
+            check_fdr_inputs(basin, years)
+            flow_direction_processing(basin, years[0])
+        except Exception:
+            error = traceback.format_exc()
+            results += [{'job': f"{basin}-{year}", 'status': 'failed', 'seconds': time.perf_counter() - start, 'error': error}
+                        for year in years]
+            continue
+        jobs += [(f"{basin}-{year}", preprocess_year, (basin, year)) for year in years]
+
+    results += run_jobs(jobs, workers)
+    report_jobs(results)
         
 
 if __name__=='__main__':
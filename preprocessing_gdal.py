@@ -0,0 +1,435 @@
+# Preprocessing without arcpy (GDAL/OGR and numpy), for the Linux batch nodes
+#
+# Same steps and file names as preprocessing.py. The flowlines are clipped to the basin with an OGR spatial filter into
+# an in-memory layer, rasterized onto the LULC grid with gdal.Rasterize in /vsimem and burnt into the land cover with
+# numpy, so no intermediate shapefile or TIFF is written.
+#
+# The flow mask is built from the rasterized streams in row bands: a band plus buffer_distance of halo rows is either
+# run through an exact Euclidean distance transform (scipy) or dilated with a disk, and only the thresholded uint8 (or
+# bit-packed) mask is kept. No distance raster is made. In memory the mask is 1 within buffer_distance of a stream and 0
+# elsewhere (a PackedMask holds the same bits). Only the file gets the encoding of the arcpy mask: 1 within
+# buffer_distance, 999 (NODATA) elsewhere.
+#
+# The DEM is warped onto the LULC grid and its sinks are filled with the Priority-Flood of dem_fill.py, in memory or,
+# with fill_tile_size set, tile by tile from and to disk. The flow direction is computed from the filled DEM by
+# flow_direction.py, in the same way.
+#
+# preprocess_basin chains all of it in memory for one basin: the grid of the first year's LULC is the one grid every
+# array is made on (a LULC year that isn't on it is warped onto it), the streams, flow mask and flow direction are made
+# once, and each year only burns the streams into its land cover. Only the three rasters the traversal reads are
+# written (LULC, FDR and flow mask, as before), and with persist=False none at all: the arrays are returned instead.
+# Nothing else touches the disk, except the clipped and filled DEM of the out-of-core fill.
+
+from osgeo import gdal, ogr, osr
+import os
+import numpy as np
+from dem_fill import fill_depressions, fill_tiled
+from flow_direction import flow_directions, flow_directions_tiled, fdr_no_data
+from job_scheduler import run_jobs, report_jobs
+from raster_grid import PackedMask
+gdal.UseExceptions()
+ogr.UseExceptions()
+
+try:
+    from scipy import ndimage
+except ImportError:
+    ndimage = None
+
+stream_value = 21
+lulc_no_data = 999
+buffer_distance = 200       # metres, width of the flow mask on either side of the streams
+mask_band_rows = 2048
+# Flow mask values, as written by preprocessing.py (Con(distance <= 200, 1, 999) with NODATA 999). The traversal only
+# skips cells where the mask is 0, so like the arcpy mask this one doesn't limit its start cells; LU_Transitions.py
+# counts the cells that are 1
+mask_inside = 1
+mask_outside = 999
+dem_no_data = -9999.0
+fill_tile_size = None       # tile size of the out-of-core fill for DEMs that don't fit in memory; None fills in memory
+
+creation_options = ['COMPRESS=LZW', 'TILED=YES', 'BIGTIFF=IF_SAFER']
+
+
+def ensure_dir(path):
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+
+def read_grid(path):
+    # The grid every preprocessing output is aligned to (that of the resampled LULC), and the LULC band itself
+    ds = gdal.Open(path, 0)
+    band = ds.GetRasterBand(1)
+    grid = {
+        'shape': (ds.RasterYSize, ds.RasterXSize),
+        'geotransform': ds.GetGeoTransform(),
+        'projection': ds.GetProjection(),
+        }
+    arr = band.ReadAsArray()
+    nodata = band.GetNoDataValue()
+    del band, ds
+    return grid, arr, nodata
+
+
+def read_on_grid(path, grid):
+    # A raster's first band on the grid, warped onto it (nearest neighbour) if it isn't already aligned, and its NODATA
+    ds = gdal.Open(path, 0)
+    if (ds.RasterYSize, ds.RasterXSize) != grid['shape'] or ds.GetGeoTransform() != grid['geotransform']:
+        print(f"{path} is not on the basin grid, warping it onto it")
+        length, width = grid['shape']
+        ds = gdal.Warp('', ds, format='MEM', outputBounds=grid_bounds(grid), width=width, height=length,
+                       dstSRS=grid['projection'], resampleAlg='near')
+    band = ds.GetRasterBand(1)
+    arr = band.ReadAsArray()
+    nodata = band.GetNoDataValue()
+    del band, ds
+    return arr, nodata
+
+
+def grid_bounds(grid):
+    # (xmin, ymin, xmax, ymax) of a north-up grid
+    x0, dx, _, y0, _, dy = grid['geotransform']
+    length, width = grid['shape']
+    return min(x0, x0 + dx * width), min(y0, y0 + dy * length), max(x0, x0 + dx * width), max(y0, y0 + dy * length)
+
+
+def spatial_ref(wkt):
+    srs = osr.SpatialReference()
+    srs.ImportFromWkt(wkt)
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def layer_srs(layer):
+    srs = layer.GetSpatialRef()
+    if srs is not None:
+        srs = srs.Clone()
+        srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    return srs
+
+
+def basin_geometry(boundary_file, srs=None):
+    # Union of the boundary polygons, in srs (if given)
+    ds = ogr.Open(boundary_file, 0)
+    layer = ds.GetLayer()
+    boundary = None
+    for feature in layer:
+        geom = feature.GetGeometryRef()
+        if geom is None:
+            continue
+        boundary = geom.Clone() if boundary is None else boundary.Union(geom)
+    if boundary is None:
+        raise ValueError(f"{boundary_file} has no polygons")
+    source = layer_srs(layer)
+    if srs is not None and source is not None and not source.IsSame(srs):
+        boundary.Transform(osr.CoordinateTransformation(source, srs))
+    return boundary
+
+
+def clip_flowlines(flowline_file, boundary_file, projection):
+    # 1. The flowlines inside the basin boundary, reprojected to the grid's projection, in an in-memory data source.
+    # The spatial filter skips every flowline whose bounding box misses the basin before any geometry is clipped
+    ds = ogr.Open(flowline_file, 0)
+    layer = ds.GetLayer()
+    source = layer_srs(layer)
+    target = spatial_ref(projection)
+    boundary = basin_geometry(boundary_file, source)
+    layer.SetSpatialFilter(boundary)
+    to_grid = osr.CoordinateTransformation(source, target) if source is not None and not source.IsSame(target) else None
+
+    clipped = ogr.GetDriverByName('Memory').CreateDataSource('flowlines')
+    out = clipped.CreateLayer('flowlines', target, ogr.wkbUnknown)
+    for feature in layer:
+        geom = feature.GetGeometryRef()
+        if geom is None:
+            continue
+        geom = geom.Intersection(boundary)
+        if geom is None or geom.IsEmpty():
+            continue
+        if to_grid is not None:
+            geom.Transform(to_grid)
+        part = ogr.Feature(out.GetLayerDefn())
+        part.SetGeometry(geom)
+        out.CreateFeature(part)
+    print(f"Clipped {out.GetFeatureCount()} flowlines")
+    return clipped
+
+
+def rasterize_streams(flowlines, grid, all_touched=False):
+    # 2. Stream cells (uint8 0/1) on the grid. Rasterized into /vsimem and read back, so nothing is written to disk
+    length, width = grid['shape']
+    path = f"/vsimem/streams_{os.getpid()}_{id(flowlines)}.tif"
+    try:
+        ds = gdal.Rasterize(path, flowlines, format='GTiff', outputType=gdal.GDT_Byte, outputSRS=grid['projection'],
+                            outputBounds=grid_bounds(grid), width=width, height=length, burnValues=[1], initValues=[0],
+                            allTouched=all_touched)
+        streams = ds.ReadAsArray()
+        del ds
+    finally:
+        gdal.Unlink(path)
+    return streams
+
+
+def burn_streams(lulc, streams, nodata):
+    # 3. Water (21) on every stream cell, the LULC everywhere else. NODATA cells without a stream become 999
+    burnt = np.where(streams > 0, stream_value, lulc).astype(np.uint16)
+    if nodata is not None:
+        burnt[(lulc == nodata) & (streams == 0)] = lulc_no_data
+    return burnt
+
+
+def disk_rows(radius):
+    # (row offset, half width) of the cells within radius cells of the centre, for every row offset
+    r = int(np.floor(radius))
+    return [(dv, int(np.floor(np.sqrt(radius ** 2 - dv ** 2)))) for dv in range(-r, r + 1)]
+
+
+def dilate_row(streams, half_width):
+    # Cells with a stream cell at most half_width columns away in the same row
+    width = streams.shape[1]
+    counts = np.zeros((streams.shape[0], width + 1), dtype=np.int32)
+    np.cumsum(streams, axis=1, out=counts[:, 1:])
+    cols = np.arange(width)
+    return counts[:, np.minimum(cols + half_width + 1, width)] > counts[:, np.maximum(cols - half_width, 0)]
+
+
+def mask_band(window, radius, halo):
+    # Flow mask of the rows [halo, len(window) - halo) of window: cells within radius cells (centre to centre) of a
+    # stream cell. window holds halo rows above and below them (zero-padded beyond the raster)
+    rows = window.shape[0] - 2 * halo
+    if not window.any():
+        return np.zeros((rows, window.shape[1]), dtype=bool)
+    if ndimage is not None:
+        return ndimage.distance_transform_edt(~window)[halo:halo + rows] <= radius
+    band = np.zeros((rows, window.shape[1]), dtype=bool)
+    dilated = {}
+    for dv, half_width in disk_rows(radius):
+        if half_width not in dilated:
+            dilated[half_width] = dilate_row(window, half_width)
+        band |= dilated[half_width][halo + dv:halo + dv + rows]
+    return band
+
+
+def flow_mask(streams, radius, band_rows=mask_band_rows, packed=False):
+    # Cells within radius cells of a stream, as a uint8 0/1 array or (packed=True) a PackedMask, built band_rows rows at
+    # a time so only one band's distances exist at any time
+    length, width = streams.shape
+    halo = int(np.floor(radius))
+    streams = streams != 0
+    out = np.zeros((length, (width + 7) // 8 if packed else width), dtype=np.uint8)
+    for r0 in range(0, length, band_rows):
+        r1 = min(r0 + band_rows, length)
+        window = np.zeros((r1 - r0 + 2 * halo, width), dtype=bool)
+        w0, w1 = max(r0 - halo, 0), min(r1 + halo, length)
+        window[w0 - r0 + halo:w1 - r0 + halo] = streams[w0:w1]
+        band = mask_band(window, radius, halo)
+        out[r0:r1] = np.packbits(band, axis=1) if packed else band
+    return PackedMask.from_bits(out, streams.shape) if packed else out
+
+
+def encode_mask(mask):
+    # 0/1 flow mask -> the 1/999 uint16 encoding of the mask files (for writing only; the arrays stay 0/1)
+    return np.where(mask != 0, mask_inside, mask_outside).astype(np.uint16)
+
+
+def write_mask(path, mask, grid):
+    # The flow mask file (UInt16, NODATA 999), encoded band by band so no full-size uint16 copy is made
+    ds = create_raster(path, grid, mask_outside, gdal.GDT_UInt16)
+    band = ds.GetRasterBand(1)
+    for row in range(0, mask.shape[0], mask_band_rows):
+        band.WriteArray(encode_mask(mask[row:row + mask_band_rows]), 0, row)
+    ds.FlushCache()
+    del band, ds
+
+
+def warp_options(grid):
+    # Nearest neighbour onto the grid, as ExtractByMask does with the LULC as snap raster
+    length, width = grid['shape']
+    return dict(outputBounds=grid_bounds(grid), width=width, height=length, dstSRS=grid['projection'],
+                resampleAlg='near', outputType=gdal.GDT_Float32, dstNodata=dem_no_data)
+
+
+def clip_dem(input_dem, grid, outside):
+    # 6. The DEM on the grid, NODATA outside the basin (where the LULC is NODATA), in memory
+    ds = gdal.Warp('', input_dem, format='MEM', **warp_options(grid))
+    dem = ds.ReadAsArray()
+    del ds
+    dem[outside] = dem_no_data
+    return dem
+
+
+def clip_dem_file(input_dem, grid, outside, path):
+    # clip_dem for the out-of-core fill: written to path and masked band by band
+    ds = gdal.Warp(path, input_dem, format='GTiff', creationOptions=creation_options, **warp_options(grid))
+    band = ds.GetRasterBand(1)
+    length, width = grid['shape']
+    for row in range(0, length, mask_band_rows):
+        block = band.ReadAsArray(0, row, width, min(mask_band_rows, length - row))
+        block[outside[row:row + block.shape[0]]] = dem_no_data
+        band.WriteArray(block, 0, row)
+    ds.FlushCache()
+    del band, ds
+
+
+def fill_raster(dem_file, filled_file, tile_size):
+    # 7. Out-of-core depression filling, tile_size x tile_size cells at a time
+    src = gdal.Open(dem_file, 0)
+    band = src.GetRasterBand(1)
+    grid = {
+        'shape': (src.RasterYSize, src.RasterXSize),
+        'geotransform': src.GetGeoTransform(),
+        'projection': src.GetProjection(),
+        }
+    no_data = band.GetNoDataValue()
+    ds = create_raster(filled_file, grid, dem_no_data if no_data is None else no_data, gdal.GDT_Float32)
+    out = ds.GetRasterBand(1)
+    fill_tiled(lambda row, col, rows, cols: band.ReadAsArray(col, row, cols, rows),
+               lambda row, col, arr: out.WriteArray(arr, col, row),
+               grid['shape'], tile_size, no_data)
+    ds.FlushCache()
+    del out, ds, band, src
+
+
+def flow_direction_raster(filled_file, fdr_file, tile_size):
+    # 8. Out-of-core D8 flow direction, tile_size x tile_size cells at a time
+    src = gdal.Open(filled_file, 0)
+    band = src.GetRasterBand(1)
+    grid = {
+        'shape': (src.RasterYSize, src.RasterXSize),
+        'geotransform': src.GetGeoTransform(),
+        'projection': src.GetProjection(),
+        }
+    ds = create_raster(fdr_file, grid, fdr_no_data, gdal.GDT_Byte)
+    out = ds.GetRasterBand(1)
+    flow_directions_tiled(lambda row, col, rows, cols: band.ReadAsArray(col, row, cols, rows),
+                          lambda row, col, arr: out.WriteArray(arr, col, row),
+                          grid['shape'], tile_size, band.GetNoDataValue())
+    ds.FlushCache()
+    del out, ds, band, src
+
+
+def create_raster(path, grid, nodata, data_type, options=()):
+    ds = gdal.GetDriverByName('GTiff').Create(path, grid['shape'][1], grid['shape'][0], 1, data_type,
+                                              options=creation_options + list(options))
+    ds.SetGeoTransform(grid['geotransform'])
+    ds.SetProjection(grid['projection'])
+    ds.GetRasterBand(1).SetNoDataValue(nodata)
+    return ds
+
+
+def write_raster(path, arr, grid, nodata, data_type, options=()):
+    ds = create_raster(path, grid, nodata, data_type, options)
+    band = ds.GetRasterBand(1)
+    band.WriteArray(arr, 0, 0)
+    ds.FlushCache()
+    del band, ds
+
+
+def lulc_file(basin, year):
+    # The resampled LULC, or the warped VRT of Landuse_Analysis/LU_Warp.py when it hasn't been written out
+    tif=fr"D:\Ashok\Catskills_Project\Inputs\Landuse\{basin}\{basin}_{year}_ccap_LC_Resampled10m.tif"
+    vrt=os.path.splitext(tif)[0] + '.vrt'
+    return vrt if not os.path.exists(tif) and os.path.exists(vrt) else tif
+
+
+def output_files(basin, year):
+    # The inputs of the traversal (traversability_numpy.input_files)
+    LULC_burntin=fr"D:\Ashok\Catskills_Project\Inputs\{basin}\{basin}_LULC_10m_{year}.tif"
+    flow_direction_raster=fr"D:\Ashok\Catskills_Project\Inputs\{basin}\FDR_10m.tif"
+    buffer_mask=fr"D:\Ashok\Catskills_Project\Inputs\{basin}\{basin}_{year}_Flow_Mask_200m.tif"
+    return LULC_burntin, flow_direction_raster, buffer_mask
+
+
+def stream_cells(basin, grid):
+    # Steps 1-2: the basin's flowlines rasterized on the grid
+    catskills_flowline=r"D:\Ashok\Catskills_Project\Inputs\Flowlines\NHPFlowline-UTM18N.shp"
+    basin_boundary=fr"D:\Ashok\Catskills_Project\Inputs\Subbasin_Boundaries\{basin}_boundary.shp"
+
+    flowlines = clip_flowlines(catskills_flowline, basin_boundary, grid['projection'])
+    print("1/8: Clipped Flowlines")
+
+    streams = rasterize_streams(flowlines, grid)
+    del flowlines
+    print("2/8: Converted flowlines to raster")
+    return streams
+
+
+def flow_direction_processing(basin, grid, outside, fdr_file):
+    # Steps 6-8: the DEM on the grid, NODATA outside the basin, filled, and its flow direction (uint8, NODATA 255).
+    # Returns the flow direction; with fill_tile_size set it is written to fdr_file instead and None is returned
+    input_dem=r"D:\Ashok\Catskills_Project\Inputs\DEM\Mosaiced_Raster.tif"
+    clipped_dem=fr"D:\Ashok\Catskills_Project\Inputs\DEM\Clipped_DEM_{basin}.tif"
+    filled_dem=fr"D:\Ashok\Catskills_Project\Inputs\DEM\Filled_DEM_{basin}.tif"
+
+    if fill_tile_size:
+        # too large for memory: the out-of-core fill works from and to disk
+        clip_dem_file(input_dem, grid, outside, clipped_dem)
+        print("6/8: Clipped the DEM to basin boundary")
+        fill_raster(clipped_dem, filled_dem, fill_tile_size)
+        print("7/8: Filled the sinks of DEM")
+        flow_direction_raster(filled_dem, fdr_file, fill_tile_size)
+        print("8/8: Created flow direction raster")
+        return None
+
+    dem = clip_dem(input_dem, grid, outside)
+    print("6/8: Clipped the DEM to basin boundary")
+    filled = fill_depressions(dem, dem_no_data)
+    del dem
+    print("7/8: Filled the sinks of DEM")
+    fdr = flow_directions(filled, dem_no_data)
+    print("8/8: Created flow direction raster")
+    return fdr
+
+
+def preprocess_basin(basin, years, persist=True):
+    # Steps 1-8 for every year of a basin. With persist=True the burnt-in LULC, flow mask and flow direction are written
+    # to the traversal's input files; otherwise nothing is written and {year: (lc, dist_mask)}, the flow direction, its
+    # NODATA value and the grid are returned. The returned dist_mask is flow_mask's uint8 1/0, not the 1/999 of the
+    # mask files: the traversal only skips 0, so it starts no droplets outside the buffer, where it does start them on
+    # the 999 cells of a mask file
+    grid, lulc, nodata = read_grid(lulc_file(basin, years[0]))
+    outside = lulc == nodata if nodata is not None else np.zeros(lulc.shape, dtype=bool)
+    del lulc
+
+    streams = stream_cells(basin, grid)
+    cell_size = abs(grid['geotransform'][1])
+    mask = flow_mask(streams, buffer_distance / cell_size)
+    print(f"4-5/8: Created {buffer_distance:g}m stream buffer mask")
+
+    _, fdr_file, _ = output_files(basin, years[0])
+    fdr = flow_direction_processing(basin, grid, outside, fdr_file)
+    del outside
+    if fdr is None:
+        # written by the out-of-core path already
+        if not persist:
+            fdr, _ = read_on_grid(fdr_file, grid)
+    elif persist:
+        write_raster(fdr_file, fdr, grid, fdr_no_data, gdal.GDT_Byte)
+
+    years_out = {}
+    for year in years:
+        lulc, nodata = read_on_grid(lulc_file(basin, year), grid)
+        burnt = burn_streams(lulc, streams, nodata)
+        del lulc
+        print(f"3/8: Burned streamlines into land cover raster ({year})")
+        if persist:
+            LULC_burntin, _, buffer_mask = output_files(basin, year)
+            write_raster(LULC_burntin, burnt, grid, lulc_no_data, gdal.GDT_UInt16)
+            write_mask(buffer_mask, mask, grid)
+        else:
+            years_out[year] = (burnt, mask)
+    if not persist:
+        return years_out, fdr, fdr_no_data, grid
+
+
+def main():
+    basins = ["Cannonsville"]
+    years = [1996, 2001, 2006, 2010, 2016, 2021]
+    workers = None  # number of processes, one basin each; None = one per core
+
+    for basin in basins:
+        ensure_dir(fr"D:\Ashok\Catskills_Project\Inputs\{basin}")
+    report_jobs(run_jobs([(basin, preprocess_basin, (basin, years)) for basin in basins], workers))
+
+
+if __name__=='__main__':
+    main()
@@ -0,0 +1,117 @@
+# Uncompressed on-disk cache of the input rasters
+#
+# Decoding the LZW GeoTIFFs (LULC, FDR, flow mask) in full takes a noticeable part of every run, and the same basins are
+# rerun many times while tuning parameters. read_cached converts a raster once into a plain .npy file with a .json
+# sidecar holding its georeference and NODATA value; later runs open the .npy with np.load(mmap_mode='r'), so only the
+# pages that are actually used get read.
+#
+# A cache entry records the size, mtime and SHA-256 of its source file. It is rebuilt when the size changes, or when the
+# mtime changes and the contents hash differently (a file that was only touched or copied keeps its entry).
+# verify_hash=True hashes the source on every use.
+
+import os
+import json
+import hashlib
+import numpy as np
+from osgeo import gdal
+
+gdal.UseExceptions()
+
+strip_mb = 64           # rows copied at once when an entry is built, in MB
+
+
+def file_hash(path, chunk_mb=16):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_mb * 2**20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def cache_paths(path, cache_dir):
+    # One entry per source path: <name>_<hash of the full path>.npy/.json
+    path = os.path.abspath(path)
+    key = hashlib.sha1(path.encode('utf-8')).hexdigest()[:12]
+    stem = os.path.join(cache_dir, f"{os.path.splitext(os.path.basename(path))[0]}_{key}")
+    return stem + '.npy', stem + '.json'
+
+
+def is_current(meta, path, verify_hash=False):
+    stat = os.stat(path)
+    if meta.get('size') != stat.st_size:
+        return False
+    if meta.get('mtime_ns') == stat.st_mtime_ns and not verify_hash:
+        return True
+    return meta.get('sha256') == file_hash(path)
+
+
+def build_entry(path, npy_file, meta_file):
+    ds = gdal.Open(path, 0)
+    band = ds.GetRasterBand(1)
+    width, length = ds.RasterXSize, ds.RasterYSize
+    stat = os.stat(path)
+
+    # write to temporary names first, so an interrupted run never leaves a half-written entry behind. The raster is
+    # copied a strip of whole blocks at a time into the memory-mapped .npy, so it is never in memory in full
+    tmp_file = npy_file + '.tmp.npy'
+    block_rows = band.GetBlockSize()[1]
+    row_bytes = width * max(gdal.GetDataTypeSize(band.DataType) // 8, 1)
+    rows = max(block_rows, int(strip_mb * 2**20 // row_bytes) // block_rows * block_rows)
+    strip = band.ReadAsArray(0, 0, width, min(rows, length))
+    arr = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=strip.dtype, shape=(length, width))
+    arr[:strip.shape[0]] = strip
+    for row in range(strip.shape[0], length, rows):
+        n = min(rows, length - row)
+        arr[row:row + n] = band.ReadAsArray(0, row, width, n)
+    arr.flush()
+
+    meta = {
+        'source': os.path.abspath(path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': file_hash(path),
+        'shape': list(arr.shape),
+        'dtype': arr.dtype.str,
+        'driver': ds.GetDriver().ShortName,
+        'geotransform': list(ds.GetGeoTransform()),
+        'projection': ds.GetProjection(),
+        'nodata': band.GetNoDataValue(),
+        }
+    del arr, strip, band, ds
+
+    os.replace(tmp_file, npy_file)
+    with open(meta_file + '.tmp', 'w') as f:
+        json.dump(meta, f, indent=1)
+    os.replace(meta_file + '.tmp', meta_file)
+    return meta
+
+
+def read_cached(path, cache_dir, verify_hash=False):
+    # Returns the raster as a read-only memory-mapped array and its metadata (driver short name, geotransform,
+    # projection, nodata), converting it into the cache first if there is no current entry for it
+    os.makedirs(cache_dir, exist_ok=True)
+    npy_file, meta_file = cache_paths(path, cache_dir)
+
+    meta = None
+    if os.path.exists(npy_file) and os.path.exists(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+        if not is_current(meta, path, verify_hash):
+            print(f"Cache entry of {path} is out of date, rebuilding it")
+            meta = None
+        elif meta['mtime_ns'] != os.stat(path).st_mtime_ns:
+            # same contents under a new mtime: keep the entry and remember the new mtime
+            meta['mtime_ns'] = os.stat(path).st_mtime_ns
+            with open(meta_file, 'w') as f:
+                json.dump(meta, f, indent=1)
+
+    if meta is None:
+        meta = build_entry(path, npy_file, meta_file)
+        print(f"Cached {path} in {npy_file}")
+
+    arr = np.load(npy_file, mmap_mode='r')
+    if list(arr.shape) != meta['shape'] or arr.dtype.str != meta['dtype']:
+        # the .npy doesn't belong to the sidecar (e.g. one of them was replaced by hand)
+        meta = build_entry(path, npy_file, meta_file)
+        arr = np.load(npy_file, mmap_mode='r')
+    return arr, meta
@@ -0,0 +1,37 @@
+# Grid definitions shared by the preprocessing and the traversal
+#
+# Kept apart from traversability_numpy so that the preprocessing can use them without importing the whole traversal
+# (and its numba, class scheme and output writer set-up).
+
+import numpy as np
+
+# (row, column) offset of the downstream cell for each flow direction value (1 E, 2 SE, 4 S, 8 SW, 16 W, 32 NW, 64 N,
+# 128 NE)
+offsets = {
+    1: (0, 1),
+    2: (1, 1),
+    4: (1, 0),
+    8: (1, -1),
+    16: (0, -1),
+    32: (-1, -1),
+    64: (-1, 0),
+    128: (-1, 1),
+}
+
+
+class PackedMask:
+    # Flow mask stored 8 cells per byte (np.packbits, row by row)
+    def __init__(self, mask):
+        self.shape = mask.shape
+        self.bits = np.packbits(mask != 0, axis=1)
+
+    @classmethod
+    def from_bits(cls, bits, shape):
+        # From rows already packed with np.packbits(..., axis=1), e.g. a mask built band by band
+        packed = cls.__new__(cls)
+        packed.shape = tuple(shape)
+        packed.bits = bits
+        return packed
+
+    def unpack(self):
+        return np.unpackbits(self.bits, axis=1, count=self.shape[1]).view(bool)
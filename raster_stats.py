@@ -0,0 +1,219 @@
+# Block-wise statistics of rasters
+#
+# The rasters are read a strip of whole blocks at a time (iter_blocks), so memory stays at about strip_mb per raster
+# however large the raster is, and the counts are accumulated with np.bincount, which needs no sort and no copy of the
+# valid cells.
+#
+# transition_matrices reads a stack of land cover years (and optionally the flow mask) in one pass and counts the
+# from -> to class pairs of any number of year pairs by encoding each pair as from*256+to.
+#
+# raster_histogram streams a raster into a histogram that can be merged with others and answers quantile and
+# exceedance queries: IntHistogram (one bin per integer value) for integer rasters, which gives exactly what
+# np.percentile and a count over the full array give, and QuantileSketch (log-spaced bins, DDSketch) for floating
+# point rasters, within relative_accuracy.
+
+import math
+from concurrent.futures import ProcessPoolExecutor
+import os
+import numpy as np
+from osgeo import gdal
+
+gdal.UseExceptions()
+
+strip_mb = 64           # rows read at once per raster, in MB
+
+
+def iter_blocks(paths):
+    # Yields (row, [block of each raster]) for rasters of the same size, strip by strip
+    datasets = [gdal.Open(p, 0) for p in paths]
+    bands = [ds.GetRasterBand(1) for ds in datasets]
+    width, length = datasets[0].RasterXSize, datasets[0].RasterYSize
+    for p, ds in zip(paths, datasets):
+        if (ds.RasterXSize, ds.RasterYSize) != (width, length):
+            raise ValueError(f"{p} is {ds.RasterYSize} x {ds.RasterXSize}, expected {length} x {width} like {paths[0]}")
+
+    block_rows = max(b.GetBlockSize()[1] for b in bands)
+    bytes_per_row = width * max(gdal.GetDataTypeSize(b.DataType) // 8 for b in bands)
+    rows = max(block_rows, int(strip_mb * 2**20 // max(bytes_per_row, 1)) // block_rows * block_rows)
+    for row in range(0, length, rows):
+        n = min(rows, length - row)
+        yield row, [b.ReadAsArray(0, row, width, n) for b in bands]
+
+
+def add_counts(total, values, minlength):
+    # total + bincount(values), growing total when values go beyond it
+    counts = np.bincount(values.ravel(), minlength=minlength)
+    if counts.size > total.size:
+        counts[:total.size] += total
+        return counts
+    total[:counts.size] += counts
+    return total
+
+
+def class_counts(path, exclude=(999,), minlength=256):
+    # Number of cells of each value (index = value) of an integer raster, the values in exclude set to 0
+    counts = np.zeros(minlength, dtype=np.int64)
+    for _, (block,) in iter_blocks([path]):
+        counts = add_counts(counts, block, minlength)
+    for value in exclude:
+        if value < counts.size:
+            counts[value] = 0
+    return counts
+
+
+def transition_matrices(paths, pairs, mask_path=None, no_data=999):
+    # {(i, j): 256 x 256 matrix of cell counts, [from class, to class]} for each pair (i, j) of indices into paths. Cells
+    # that are NODATA (or any value above 255) in either year are left out, and with mask_path so are the cells where the
+    # mask isn't 1
+    counts = {pair: np.zeros(256 * 256, dtype=np.int64) for pair in pairs}
+    needed = sorted({i for pair in pairs for i in pair})
+    read = [paths[i] for i in needed] + ([mask_path] if mask_path else [])
+    for _, blocks in iter_blocks(read):
+        inside = blocks[-1] == 1 if mask_path else None
+        years = {}
+        for i, block in zip(needed, blocks):
+            valid = (block != no_data) & (block < 256)
+            years[i] = (block.astype(np.int32), valid if inside is None else valid & inside)
+        for (i, j), total in counts.items():
+            (a, valid_a), (b, valid_b) = years[i], years[j]
+            valid = valid_a & valid_b
+            total += np.bincount(a[valid] * 256 + b[valid], minlength=256 * 256)
+    return {pair: total.reshape(256, 256) for pair, total in counts.items()}
+
+
+class IntHistogram:
+    # Count of every integer value between the smallest and largest one added
+    def __init__(self):
+        self.offset = 0
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def extend(self, lo, hi):
+        if self.counts.size == 0:
+            self.offset, self.counts = lo, np.zeros(hi - lo + 1, dtype=np.int64)
+            return
+        new_lo, new_hi = min(lo, self.offset), max(hi, self.offset + self.counts.size - 1)
+        if (new_lo, new_hi) != (self.offset, self.offset + self.counts.size - 1):
+            counts = np.zeros(new_hi - new_lo + 1, dtype=np.int64)
+            counts[self.offset - new_lo:self.offset - new_lo + self.counts.size] = self.counts
+            self.offset, self.counts = new_lo, counts
+
+    def add(self, values):
+        values = np.asarray(values).ravel()
+        if values.size == 0:
+            return
+        self.extend(int(values.min()), int(values.max()))
+        self.counts += np.bincount(values.astype(np.int64) - self.offset, minlength=self.counts.size)
+
+    def merge(self, other):
+        if other.counts.size:
+            self.extend(other.offset, other.offset + other.counts.size - 1)
+            start = other.offset - self.offset
+            self.counts[start:start + other.counts.size] += other.counts
+        return self
+
+    @property
+    def n(self):
+        return int(self.counts.sum())
+
+    def values_counts(self):
+        present = np.flatnonzero(self.counts)
+        return present + self.offset, self.counts[present]
+
+    def kth(self, k):
+        # k-th smallest value (0-based)
+        return self.offset + int(np.searchsorted(np.cumsum(self.counts), k, side='right'))
+
+    def quantile(self, q):
+        # Same as np.percentile(values, 100*q) with linear interpolation
+        n = self.n
+        if n == 0:
+            return None
+        h = q * (n - 1)
+        lo = math.floor(h)
+        v_lo = self.kth(lo)
+        v_hi = self.kth(min(lo + 1, n - 1))
+        return v_lo + (h - lo) * (v_hi - v_lo)
+
+    def count_above(self, threshold):
+        # Number of values > threshold
+        start = max(math.floor(threshold) + 1 - self.offset, 0)
+        return int(self.counts[start:].sum())
+
+
+class QuantileSketch:
+    # DDSketch: value v > 0 goes to bin ceil(log(v) / log(gamma)), so every bin spans values within relative_accuracy
+    # of its representative value; negative values are binned by magnitude. Bins are IntHistograms, so sketches merge
+    # exactly
+    def __init__(self, relative_accuracy=0.01):
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = IntHistogram()
+        self.negative = IntHistogram()
+        self.zeros = 0
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        self.positive.add(np.ceil(np.log(values[values > 0]) / self.log_gamma))
+        self.negative.add(np.ceil(np.log(-values[values < 0]) / self.log_gamma))
+        self.zeros += int(np.count_nonzero(values == 0))
+
+    def merge(self, other):
+        self.positive.merge(other.positive)
+        self.negative.merge(other.negative)
+        self.zeros += other.zeros
+        return self
+
+    @property
+    def n(self):
+        return self.positive.n + self.negative.n + self.zeros
+
+    def value(self, key):
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def kth(self, k):
+        n_negative = self.negative.n
+        if k < n_negative:
+            # the largest magnitudes come first
+            return -self.value(self.negative.kth(n_negative - 1 - k))
+        if k < n_negative + self.zeros:
+            return 0.0
+        return self.value(self.positive.kth(k - n_negative - self.zeros))
+
+    def quantile(self, q):
+        n = self.n
+        if n == 0:
+            return None
+        h = q * (n - 1)
+        lo = math.floor(h)
+        v_lo, v_hi = self.kth(lo), self.kth(min(lo + 1, n - 1))
+        return v_lo + (h - lo) * (v_hi - v_lo)
+
+    def count_above(self, threshold):
+        # Values whose bin lies above threshold
+        count = 0
+        for hist, sign in [(self.positive, 1), (self.negative, -1)]:
+            keys, counts = hist.values_counts()
+            count += int(counts[sign * self.value(keys) > threshold].sum())
+        return count + (self.zeros if threshold < 0 else 0)
+
+
+def raster_histogram(path, nodata=None, relative_accuracy=0.01):
+    # Histogram of the valid cells of a raster (nodata and NaN left out), read strip by strip. None if the file is missing
+    if not os.path.exists(path):
+        return None
+    hist = None
+    for _, (block,) in iter_blocks([path]):
+        if hist is None:
+            hist = IntHistogram() if np.issubdtype(block.dtype, np.integer) else QuantileSketch(relative_accuracy)
+        valid = block != nodata if nodata is not None else np.ones(block.shape, dtype=bool)
+        if not np.issubdtype(block.dtype, np.integer):
+            valid &= ~np.isnan(block)
+        hist.add(block[valid])
+    return hist if hist is not None else IntHistogram()
+
+
+def raster_histograms(paths, nodata=None, workers=None):
+    # raster_histogram of every path, all rasters in parallel: {path: histogram or None}
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {p: pool.submit(raster_histogram, p, nodata) for p in paths}
+    return {p: f.result() for p, f in futures.items()}
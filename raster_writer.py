@@ -0,0 +1,89 @@
+# Output writing for the traversal rasters
+#
+# write_bands puts all output rasters of a basin-year into one tiled multi-band GeoTIFF (or a Cloud-Optimized GeoTIFF)
+# with named bands, horizontal differencing predictor and multithreaded LZW compression, and builds the overviews in
+# the same step. BackgroundWriter runs those writes on a thread so the next basin-year can be computed while the
+# current one is flushed; GDAL releases the GIL while it compresses and writes.
+
+from concurrent.futures import ThreadPoolExecutor
+from osgeo import gdal
+from osgeo.gdalconst import GDT_Int32
+
+gdal.UseExceptions()
+
+# Creation options of every output GeoTIFF
+gtiff_options = ['COMPRESS=LZW', 'PREDICTOR=2', 'NUM_THREADS=ALL_CPUS', 'TILED=YES', 'BLOCKXSIZE=512', 'BLOCKYSIZE=512',
+                 'BIGTIFF=IF_SAFER']
+# Creation options of the outputs written band by band (streaming mode): one-row strips instead of tiles, so every band
+# of rows, whatever its height, is written as whole blocks instead of re-reading and recompressing partial 512 x 512 tiles
+stream_options = ['COMPRESS=LZW', 'PREDICTOR=2', 'NUM_THREADS=ALL_CPUS', 'TILED=NO', 'BLOCKYSIZE=1', 'BIGTIFF=IF_SAFER']
+cog_options = ['COMPRESS=LZW', 'PREDICTOR=YES', 'NUM_THREADS=ALL_CPUS', 'BLOCKSIZE=512', 'BIGTIFF=IF_SAFER',
+               'OVERVIEW_RESAMPLING=NEAREST']
+overview_levels = [2, 4, 8, 16]
+
+
+def write_bands(path, shape, bands, band_array, geotransform, projection, cog=False):
+    # bands is a list of (name, nodata); band_array(name) returns a band's array and is only called right before the
+    # band is written, so only one band has to be held in full at a time. GeoTIFF has one NODATA value per file, so the
+    # file gets the first band's value and every band also records its own in its 'NODATA' metadata item.
+    # Overviews use nearest neighbour, as the bands hold codes and counts
+    length, width = shape
+    # a COG is copied from a finished file, written next to it first (compressed, so it doesn't have to fit in memory)
+    target = path + '.tmp.tif' if cog else path
+    ds = gdal.GetDriverByName('GTiff').Create(target, width, length, len(bands), GDT_Int32,
+                                              options=gtiff_options + ['INTERLEAVE=BAND'])
+    ds.SetGeoTransform(geotransform)
+    ds.SetProjection(projection)
+    for i, (name, nodata) in enumerate(bands, 1):
+        band = ds.GetRasterBand(i)
+        band.SetDescription(name)
+        band.SetMetadataItem('NODATA', str(nodata))
+        if i == 1:
+            band.SetNoDataValue(nodata)
+        band.WriteArray(band_array(name), 0, 0)
+
+    if cog:
+        # the COG driver copies from a finished dataset and builds the overviews itself
+        gdal.GetDriverByName('COG').CreateCopy(path, ds, options=cog_options)
+        del ds
+        gdal.GetDriverByName('GTiff').Delete(target)
+    else:
+        ds.BuildOverviews('NEAREST', overview_levels)
+        ds.FlushCache()
+        del ds
+    return path
+
+
+class BackgroundWriter:
+    # Runs write jobs on one background thread. At most max_pending jobs are queued: submit waits for the oldest one
+    # beyond that, so finished outputs don't pile up in memory when writing is slower than computing
+    def __init__(self, max_pending=1):
+        self.max_pending = max_pending
+        self.pool = None
+        self.pending = []
+
+    def submit(self, label, func, *args):
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(max_workers=1)
+        while len(self.pending) >= self.max_pending:
+            self.finish(*self.pending.pop(0))
+        self.pending.append((label, self.pool.submit(func, *args)))
+
+    def finish(self, label, future):
+        # Raises the job's error under its own label, as it may only surface while a later job is submitted
+        try:
+            future.result()
+        except Exception as e:
+            raise RuntimeError(f"Writing {label} failed: {e}") from e
+
+    def wait(self):
+        # Waits for every queued write; raises the error of the first failed one
+        pending, self.pending = self.pending, []
+        errors = []
+        for label, future in pending:
+            try:
+                self.finish(label, future)
+            except Exception as e:
+                errors.append(e)
+        if errors:
+            raise errors[0]
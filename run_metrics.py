@@ -0,0 +1,116 @@
+# Run metrics of the traversal
+#
+# A RunMetrics record collects, for one basin-year, the wall time of each stage (read, mask, traverse, buildup, write),
+# the number of start cells ending with each terminal code (1000 water, 2000 too long, 3000 bad direction, 4000 cycle,
+# 5000 map edge, 6000 NODATA), a histogram of the flow path lengths of the cells that reach water, cells per second and
+# the peak memory of the process. save() writes it as JSON and appends its scalar fields to a CSV shared by all runs,
+# so slow basins and regressions show up side by side.
+#
+# With profile_dir set, the stages started with profile=True run under cProfile and the stats are dumped to
+# <profile_dir>/<label>_<stage>.prof (open with snakeviz or pstats). For sampling profilers such as py-spy the
+# traversal core runs inside the stage's own frame, so it shows up under RunMetrics.stage in the flame graph.
+
+import os
+import sys
+import csv
+import json
+import time
+import cProfile
+from contextlib import contextmanager
+import numpy as np
+
+terminal_codes = [1000, 2000, 3000, 4000, 5000, 6000]
+stage_names = ['read', 'mask', 'traverse', 'buildup', 'write']
+
+
+def peak_rss_mb():
+    # Peak resident memory of the process so far, None when it can't be read
+    try:
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak / 2**20 if sys.platform == 'darwin' else peak / 1024
+    except ImportError:
+        pass
+    try:
+        import psutil
+        return psutil.Process().memory_info().peak_wset / 2**20
+    except (ImportError, AttributeError):
+        return None
+
+
+class RunMetrics:
+    def __init__(self, label, profile_dir=None):
+        self.label = label
+        self.profile_dir = profile_dir
+        self.stages = {}            # stage name: seconds (summed when a stage runs several times)
+        self.values = {}            # any other scalar, e.g. grid size
+        self.codes = {c: 0 for c in terminal_codes}
+        self.path_lengths = {}      # hydist of the cells reaching water: count
+
+    @contextmanager
+    def stage(self, name, profile=False):
+        profiler = cProfile.Profile() if profile and self.profile_dir else None
+        start = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                os.makedirs(self.profile_dir, exist_ok=True)
+                profiler.dump_stats(os.path.join(self.profile_dir, f"{self.label}_{name}.prof"))
+            self.stages[name] = self.stages.get(name, 0.0) + time.perf_counter() - start
+
+    def count_starts(self, code, dist):
+        # Terminal codes and path lengths of one set of per-start results
+        values, counts = np.unique(code, return_counts=True)
+        for c, n in zip(values.tolist(), counts.tolist()):
+            self.codes[c] = self.codes.get(c, 0) + n
+        lengths = np.bincount(dist[code == 1000])
+        for length in np.flatnonzero(lengths).tolist():
+            self.path_lengths[length] = self.path_lengths.get(length, 0) + int(lengths[length])
+
+    def record(self):
+        starts = sum(self.codes.values())
+        traverse = self.stages.get('traverse', 0.0)
+        total = sum(self.stages.values())
+        cells = self.values.get('cells', 0)
+        return {
+            'label': self.label,
+            **self.values,
+            'start_cells': starts,
+            **{f'{name}_seconds': round(self.stages.get(name, 0.0), 4) for name in stage_names},
+            'total_seconds': round(total, 4),
+            'start_cells_per_second': round(starts / traverse, 1) if traverse > 0 else None,
+            'cells_per_second': round(cells / total, 1) if total > 0 else None,
+            'peak_rss_mb': peak_rss_mb(),
+            **{f'code_{c}': n for c, n in sorted(self.codes.items())},
+            }
+
+    def save(self, json_file, csv_file=None):
+        # JSON with the full record (path length histogram included); the scalar fields are appended to csv_file
+        record = self.record()
+        os.makedirs(os.path.dirname(json_file), exist_ok=True)
+        with open(json_file, 'w') as f:
+            json.dump({**record, 'stages': self.stages, 'path_lengths': self.path_lengths}, f, indent=1)
+
+        if csv_file:
+            append_csv(record, csv_file)
+        print(f"Saved run metrics: {json_file}")
+        return record
+
+
+def append_csv(record, csv_file):
+    # Appends one record to the metrics CSV. An existing file keeps its columns: fields it doesn't have are left out
+    # (they are still in the JSON) and fields the record doesn't have stay empty
+    fields = list(record)
+    if os.path.exists(csv_file):
+        with open(csv_file, newline='') as f:
+            fields = next(csv.reader(f), fields)
+    new = not os.path.exists(csv_file)
+    with open(csv_file, 'a', newline='') as f:
+        w = csv.DictWriter(f, fieldnames=fields, extrasaction='ignore')
+        if new:
+            w.writeheader()
+        w.writerow(record)
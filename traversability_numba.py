@@ -0,0 +1,143 @@
+# Numba-compiled version of the per-cell walk in traversability_numpy.py
+#
+# Same semantics as the recursive sequencer/move_on pair, written as an iterative loop over typed arrays so that
+# numba can compile it: no lists, dicts or recursion. The seq_list/history lists are replaced by fixed-size buffers
+# of max_flow_length+1 entries, which is the most a path can hold before it is cut off with code 2000, and the class
+# lists by the class scheme's flag table (class_scheme.py).
+#
+# The kernel only produces the per-start results (terminal code, hydist, buffer width, buildup and the
+# stream-adjacent cell). dist is also kept for the map edge and NODATA stops, so shorter flow length cutoffs can be
+# derived from the results (traversability_numpy.limit_flow_length). traversability_numpy.fill_outputs turns them into the output rasters, so the buildup
+# and buffwidmax reductions are shared with the other engines.
+#
+# numba is optional: traversability_numpy falls back to the pure-Python walk when this module can't be imported.
+
+import numpy as np
+from numba import njit
+from class_scheme import AG, URBAN, GOOD, WATER
+
+
+@njit(cache=True)
+def walk_cells(lc, fdr, start, flags, keep, no_data, max_flow_length):
+    # flags is the class scheme's 256-entry bit-flag table, keep the per-class fraction of buildup that passes
+    # through a 'good' cell (1 - removal rate), one row per removal-rate scenario. ag_out and urban_out have one
+    # row per scenario as well
+    length, width = lc.shape
+    n_start = start.size
+    n_scenario = keep.shape[0]
+
+    code = np.zeros(n_start, dtype=np.int64)
+    dist = np.zeros(n_start, dtype=np.int64)
+    wid_out = np.zeros(n_start)
+    ag_out = np.zeros((n_scenario, n_start))
+    urban_out = np.zeros((n_scenario, n_start))
+    agnum = np.zeros(n_scenario)
+    urbnum = np.zeros(n_scenario)
+    last = np.zeros(n_start, dtype=np.int64)
+
+    # history and seq_list of the current droplet
+    hist_v = np.empty(max_flow_length + 1, dtype=np.int64)
+    hist_h = np.empty(max_flow_length + 1, dtype=np.int64)
+    seq = np.empty(max_flow_length + 1, dtype=np.int64)
+
+    for s in range(n_start):
+        v = start[s] // width
+        h = start[s] % width
+        hist_v[0] = v
+        hist_h[0] = h
+        seq[0] = lc[v, h]
+        n = 1
+        k = fdr[v, h]
+
+        while True:
+            # sequencer: move to the next cell
+            if k == 1:
+                h += 1
+            elif k == 2:
+                v += 1
+                h += 1
+            elif k == 4:
+                v += 1
+            elif k == 8:
+                v += 1
+                h -= 1
+            elif k == 16:
+                h -= 1
+            elif k == 32:
+                h -= 1
+                v -= 1
+            elif k == 64:
+                v -= 1
+            elif k == 128:
+                h += 1
+                v -= 1
+            valid = k == 1 or k == 2 or k == 4 or k == 8 or k == 16 or k == 32 or k == 64 or k == 128
+
+            # move_on: check the new cell in the same order as the recursive version
+            cyclic = False
+            for m in range(n):
+                if hist_v[m] == v and hist_h[m] == h:
+                    cyclic = True
+                    break
+            if cyclic:
+                code[s] = 4000
+                dist[s] = n
+                break
+
+            if v >= length or v < 0 or h >= width or h < 0:
+                code[s] = 5000
+                dist[s] = n
+                break
+
+            if n > max_flow_length:
+                code[s] = 2000
+                break
+
+            if not valid:
+                code[s] = 3000
+                dist[s] = n
+                break
+
+            c = lc[v, h]
+            if 0 <= c < 256 and flags[c] & WATER:
+                code[s] = 1000
+                dist[s] = n
+
+                wid = 0.0
+                agnum[:] = 0.0
+                urbnum[:] = 0.0
+                for m in range(n):
+                    lc_val = seq[m]
+                    if lc_val < 0 or lc_val >= 256:
+                        continue
+                    f = flags[lc_val]
+                    if f & AG:
+                        wid = 0.0
+                        agnum += 1.0
+                    if f & URBAN:
+                        wid = 0.0
+                        urbnum += 1.0
+                    if f & GOOD:
+                        wid += 1.0
+                        for r in range(n_scenario):
+                            agnum[r] *= keep[r, lc_val]
+                            urbnum[r] *= keep[r, lc_val]
+
+                wid_out[s] = wid
+                ag_out[:, s] = agnum
+                urban_out[:, s] = urbnum
+                last[s] = hist_v[n - 1] * width + hist_h[n - 1]
+                break
+
+            if c == no_data:
+                code[s] = 6000
+                dist[s] = n
+                break
+
+            k = fdr[v, h]
+            hist_v[n] = v
+            hist_h[n] = h
+            seq[n] = c
+            n += 1
+
+    return code, dist, wid_out, ag_out, urban_out, last
@@ -57,78 +57,172 @@
 #
 
 
-import sys, os, string, fnmatch
+import sys, os, traceback
 from datetime import datetime as dt
 import numpy as np
 from osgeo import gdal
 from osgeo.gdalconst import *
 import itertools
+import json
+from contextlib import nullcontext
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from class_scheme import load_scheme, AG, URBAN, GOOD, WATER
+from job_scheduler import share_array, attach_array, run_jobs, report_jobs
+from raster_cache import read_cached
+from raster_grid import PackedMask, offsets
+from raster_writer import BackgroundWriter, write_bands, gtiff_options, stream_options
+from run_metrics import RunMetrics, append_csv, peak_rss_mb
 gdal.UseExceptions()
 
+# optional numba-compiled walk, see traversability_numba.py
+try:
+    from traversability_numba import walk_cells
+except ImportError:
+    walk_cells = None
+
 # SET GLOBAL VARIABLES #
 
 wd = r"D:\Ashok\Catskills_Project"
 
-def traversibility_algorithm(basin,year):
-    # Input files
-    # # These files MUST BE FULLY ALIGNED; exact same dimensions, pixel size, etc
-    # cd = "/net/nas3/data/gis_lab/project/MDNR_Phragmites/landscape_modeling/code/traversability/inputs/"
-    # fdr_file = os.path.join(cd,"fdr10m_clipped.tif")  # flow direction
-    # lc_file = os.path.join(cd,"lc_laura_resample2_clipped.tif")  # land cover, ccap, original classification
-    # dist_mask_file = os.path.join(cd, 'nhd_linear_cleaned_200m_dist_mask_resample_clipped.tif')
-    #"D:\Ashok\Catskills_Project\Inputs\West_Delaware\LULC_10m_2021.tif"
-
-    LULC=fr"D:\Ashok\Catskills_Project\Inputs\{basin}\{basin}_LULC_10m_{year}.tif"
-    FDR=fr"D:\Ashok\Catskills_Project\Inputs\{basin}\FDR_10m.tif"
-    buffer_mask=fr"D:\Ashok\Catskills_Project\Inputs\{basin}\{basin}_{year}_Flow_Mask_200m.tif"
-
-    fdr_file = FDR
-    lc_file = LULC
-    dist_mask_file = buffer_mask
-    output_prefix = f'NoBuffer_{basin}_{year}_'
-
-    removalrate_forest = 0.0  #0.9 #.6#0.9 #0.58 #0.9
-    removalrate_nonforest = 0.0 #0.7 #0.55#0.7 #0.20 #0.7
-
-    '''
-    # Checklists
-    # 'bad' landcover classes- including urban, and ag classes
-    #ag = [6, 7]
-    #urban = [0, 2, 3, 4, 5, 20]
-    ag = [5]#, 6, 7]
-    urban = [1, 2, 4, 11, 12]
-
-    # 'good' landcover classes- forest, grass/shrub, and wetland
-    #good = [8, 9, 10, 11, 12, 13, 14, 15, 16, 17, 18, 19, 22]
-    good = [3, 8, 9, 10, 14, 15, 16, 17, 18, 20, 21, 22, 23, 24]
-    forest = [8,9,22,24]
-
-    #water_values = [21]
-    water_values = [25] # note that there's also a 13 water code, but this is not modified NHD-specific
-    '''
-    #CCAP LULC values- Modified based on https://coast.noaa.gov/data/digitalcoast/pdf/ccap-class-scheme-regional.pdf
-
-    ag=[6,7]
-    urban=[2,3,4,5,20]
-    good=[8,9,10,11,12,13,14,15,16,17,18]
-    forest=[9,10,11]
-    water_values=[19,21,22,23]
-
-
-    # landcover values that indicate to stop sequencing: water, background, blank, newline
-    #stop = water_values[:] + [13]
-    stop = water_values[:] 
-    # valid flow direction values
-    directions = [1, 2, 4, 8, 16, 32, 64, 128]
-
-    # max_flow_length (units: number of pixels)
-    # ~100m (300 feet) is a commonly used max value according to this:
-    # http://www.wcc.nrcs.usda.gov/ftpref/wntsc/H&H/WinTR55/SheetFlowReferences.doc
-    max_flow_length = 10
-
-    # Dict to create buildup scores
-    # [coord]: {'ag':0,'urban':0}
-    buildup = {}
+# Uncompressed copies of the input rasters, memory-mapped on later runs (see raster_cache.py).
+# None reads the GeoTIFFs directly every time
+cache_dir = os.path.join(wd, "Cache")
+
+no_data = 999 #lc_ds.GetRasterBand(1).GetNoDataValue()
+# uint8 land cover can't hold 999, so compact (and any other uint8) land cover uses 255 as its NODATA value
+compact_no_data = 255
+
+removalrate_forest = 0.0  #0.9 #.6#0.9 #0.58 #0.9
+removalrate_nonforest = 0.0 #0.7 #0.55#0.7 #0.20 #0.7
+
+# Removal-rate scenarios scored from one path trace: (output prefix, removalrate_forest, removalrate_nonforest).
+# Only buildup depends on the rates; hydist, buffwid and buffwidmax are the same for every scenario.
+# The streaming mode and the recursive reference use the single removalrate_forest/removalrate_nonforest pair above
+scenarios = [('Buffer', 0.9, 0.7), ('NoBuffer', 0.0, 0.0)]
+
+# Land cover classes come from the class scheme config (C-CAP by default, see class_scheme.py). The class lists are only
+# used by the recursive reference walk; the other engines index the scheme's flag table
+scheme = load_scheme()
+ag = scheme.values('ag')
+urban = scheme.values('urban')
+good = scheme.values('good')
+forest = scheme.values('forest')
+water_values = scheme.values('water')
+
+
+# landcover values that indicate to stop sequencing: water, background, blank, newline (set per raster in
+# traverse_recursive, as the NODATA value depends on the land cover dtype)
+#stop = water_values[:] + [13]
+# valid flow direction values
+directions = [1, 2, 4, 8, 16, 32, 64, 128]
+
+# max_flow_length (units: number of pixels)
+# ~100m (300 feet) is a commonly used max value according to this:
+# http://www.wcc.nrcs.usda.gov/ftpref/wntsc/H&H/WinTR55/SheetFlowReferences.doc
+# flow_lengths lists the cutoffs to write outputs for; the paths are traced once to the largest one, which becomes
+# max_flow_length, and the shorter cutoffs are derived from that trace (e.g. [10, 20, 30] for 100, 200 and 300 m)
+flow_lengths = [10]
+max_flow_length = max(flow_lengths)
+
+# Output rasters, in the order they are written
+output_names = ['hydist', 'buffwid', 'buffwidmax', 'buildup_ag', 'buildup_urban', 'buildup_ag_and_urban']
+
+# 'separate':  one single-band GeoTIFF per output raster (the files postprocessing.py reads)
+# 'multiband': one tiled multi-band GeoTIFF per basin-year and scenario with named bands and overviews
+# 'cog':       the same as a Cloud-Optimized GeoTIFF
+output_layout = 'separate'
+
+# Writes the outputs on a background thread while the next basin-year is computed (see raster_writer.py). The process
+# pools of the tiled engine are started with 'spawn', as forking while the writer thread holds a lock can deadlock
+writer = BackgroundWriter()
+pool_context = multiprocessing.get_context('spawn')
+
+# Run metrics (stage timings, terminal codes, path lengths, peak memory; see run_metrics.py): one JSON per run next to
+# the outputs, plus one row per run in metrics_file. Set profile_dir to a folder to cProfile the traverse stage
+metrics_file = os.path.join(wd, "Outputs", "run_metrics.csv")
+profile_dir = None
+
+# Working memory per window cell of the streaming mode (inputs, next-cell index and jump tables, per-start
+# results), in bytes. Used to size the row bands from the memory ceiling
+stream_bytes_per_cell = 160
+
+# Traversal engines: 'vectorized' resolves the whole grid at once with pointer jumping,
+# 'recursive' is the original cell-by-cell sequencer/move_on walk,
+# 'numba' is the same per-cell walk compiled with numba (falls back to 'vectorized' when numba is missing, in every
+# mode)
+engines = ['vectorized', 'recursive', 'numba']
+
+
+def lc_no_data(lc):
+    return compact_no_data if lc.dtype == np.uint8 else no_data
+
+
+def start_cells(lc, fdr, dist_mask, fdr_no_data):
+    # Cells that a droplet is started from: valid flow direction and land cover, not water, inside the distance mask
+    skip = ~dist_mask.unpack() if isinstance(dist_mask, PackedMask) else dist_mask == 0
+    # two comparisons instead of np.isin, which sorts a copy of the whole raster
+    skip |= fdr == 0
+    if fdr_no_data is not None:
+        skip |= fdr == fdr_no_data
+    skip |= lc == lc_no_data(lc)
+    skip |= (scheme.flags_of(lc) & WATER) > 0
+    return ~skip
+
+
+def compact_lc(lc):
+    # uint8 land cover. Only converted when it holds nothing but 0-254 and the 999 NODATA (which becomes 255), and
+    # only when 255 isn't a class of the scheme; uint8 land cover is then widened to uint16 so that its 255 cells
+    # aren't taken for NODATA
+    if compact_no_data in scheme.class_names or scheme.flags[compact_no_data]:
+        return lc.astype(np.uint16) if lc.dtype == np.uint8 else lc
+    nodata = lc == no_data
+    if lc.dtype != np.uint8 and (((lc >= 0) & (lc < compact_no_data)) | nodata).all():
+        lc = np.where(nodata, compact_no_data, lc).astype(np.uint8)
+    return lc
+
+
+def compact_fdr(fdr, fdr_no_data):
+    # uint8 flow direction. Directions and 0 keep their value, the NODATA value becomes 255 and any other (invalid)
+    # value becomes 3, which the walk treats the same way
+    if fdr.dtype == np.uint8 or fdr_no_data in directions:
+        return fdr, fdr_no_data
+    fdr8 = np.full(fdr.shape, 3, dtype=np.uint8)
+    valid = np.isin(fdr, directions + [0])
+    fdr8[valid] = fdr[valid]
+    if fdr_no_data is not None:
+        fdr8[fdr == fdr_no_data] = compact_no_data
+        fdr_no_data = compact_no_data
+    return fdr8, fdr_no_data
+
+
+def compact_inputs(lc, fdr, dist_mask, fdr_no_data):
+    # uint8 land cover and flow direction and a bit-packed flow mask, giving the same traversal results as the raw inputs
+    fdr, fdr_no_data = compact_fdr(fdr, fdr_no_data)
+    return compact_lc(lc), fdr, PackedMask(dist_mask), fdr_no_data
+
+
+def empty_outputs(shape):
+    # Open each output array and fill it with the NODATA value (change it from '-9999' to '999' just to save space...)
+    return {
+        'hydist': np.full(shape, no_data),
+        'buffwid': np.full(shape, no_data),
+        'buffwidmax': np.full(shape, -999),
+        'buildup_ag': np.full(shape, no_data),
+        'buildup_urban': np.full(shape, no_data),
+        'buildup_ag_and_urban': np.full(shape, no_data),
+        }
+
+
+def traverse_recursive(lc, fdr, dist_mask, fdr_no_data):
+    # Original cell-by-cell walk. Kept as the reference implementation the other engines are checked against.
+
+    length, width = lc.shape
+    stop = water_values[:] + [lc_no_data(lc)]
+    outputs = empty_outputs(lc.shape)
+    hydist = outputs['hydist']
+    buffwid = outputs['buffwid']
+    buffwidmax = outputs['buffwidmax']
 
     # DEFINE FUNCTIONS #
 
@@ -181,7 +275,8 @@ def traversibility_algorithm(basin,year):
             buffwid[start_coords] = 4000
 
         # if a coordinate is out of bounds, input that out-of-bounds code
-        elif v >= length or h >= width or h < 0:
+        # (v < 0 is checked as well, otherwise numpy wraps a northward exit round to the bottom row)
+        elif v >= length or v < 0 or h >= width or h < 0:
             for o in [hydist, buffwid]:
                 o[start_coords] = 5000
 
@@ -231,16 +326,17 @@ def traversibility_algorithm(basin,year):
                                 agnum *= (1-removalrate_nonforest)
                                 urbnum *= (1-removalrate_nonforest)
 
-                    last_coords = history[-1]
-                    if last_coords not in buildup:
-                        buildup[last_coords] = {'ag':0,'urban':0}
-
-                    if agnum+urbnum > 0:
-                        buildup[last_coords]['ag'] += agnum
-                        buildup[last_coords]['urban'] += urbnum
+                    # record the buildup and width against the flat index of the stream-adjacent cell; they are
+                    # reduced per cell with the other engines' fill_stream_cells once all starts are walked
+                    nonlocal n_wet
+                    last_v, last_h = history[-1]
+                    wet_last[n_wet] = last_v * width + last_h
+                    wet_wid[n_wet] = wid
+                    wet_ag[n_wet] = agnum
+                    wet_urban[n_wet] = urbnum
+                    n_wet += 1
 
                     buffwid[start_coords] = wid # and write that value to file
-                    buffwidmax[last_coords]=max(buffwidmax[last_coords],wid)
 
 
                 else:  # if not a linear water value, indicate either edge OR non-linear water
@@ -263,145 +359,1228 @@ def traversibility_algorithm(basin,year):
                 # and re-run the sequencer program to get the next landcover value
                 sequencer(k, seq_list, bew_list, v, h, history)
 
+    starts = start_cells(lc, fdr, dist_mask, fdr_no_data)
 
-    ########################################################
-    ##################### MAIN PROGRAM #####################
-    ########################################################
+    # per-start results of the starts that reach water, in start order
+    n_start = int(np.count_nonzero(starts))
+    wet_last = np.empty(n_start, dtype=np.int64)
+    wet_wid = np.empty(n_start)
+    wet_ag = np.empty(n_start)
+    wet_urban = np.empty(n_start)
+    n_wet = 0
 
-    
+    for (i,j) in np.ndindex(lc.shape):
+        if i % 250 == 0 and j==0:   # Print every 250 rows
+            print(f"Processing row {i} of {length} ({100 * i / length:.1f}%)")
 
-    ### Open each input file - flow direction and land cover, and read those lines
-    lc_ds = gdal.Open(lc_file, 0)
-    no_data = 999 #lc_ds.GetRasterBand(1).GetNoDataValue()
-    stop.append(no_data)
-    driver = lc_ds.GetDriver()
-    geotransform = lc_ds.GetGeoTransform()
-    projection = lc_ds.GetProjection()
-    lc = lc_ds.ReadAsArray()
-    del lc_ds
+        # background, water and out-of-mask cells keep the NODATA value
+        # otherwise, reset tracking variables and run the sequencer program to acquire the hydrologic traversability sequence
+        if starts[i,j]:
+            seq_list = [lc[i,j]]
+            bew_list = []#[bew[i,j]]
+            history = [(i,j)]
+            sequencer(fdr[i,j], seq_list, bew_list, i, j, history)
+
+    # Build buffwidmax and buildup arrays
+    return fill_stream_cells(outputs, wet_wid[:n_wet], wet_ag[:n_wet], wet_urban[:n_wet], wet_last[:n_wet])
+
+
+def flat_indices(mask, dtype):
+    # np.flatnonzero(mask) as dtype, found a block at a time so the int64 indices are never all in memory at once
+    mask = mask.ravel()
+    out = np.empty(int(np.count_nonzero(mask)), dtype=dtype)
+    block = 2**22
+    n = 0
+    for i in range(0, mask.size, block):
+        sel = np.flatnonzero(mask[i:i + block])
+        out[n:n + sel.size] = sel + i
+        n += sel.size
+    return out
+
+
+def index_dtype(n):
+    # Smallest index type that holds the flat indices 0..n
+    return np.int32 if n < np.iinfo(np.int32).max else np.int64
+
+
+def next_cell_index(fdr):
+    # Flat index of the downstream cell of every cell. Index n (one past the last cell) stands for "off the map";
+    # an invalid flow direction points a cell at itself, which the walk reports as a cycle just like move_on does
+    length, width = fdr.shape
+    n = length * width
+    dtype = index_dtype(n)
+    flat_fdr = fdr.ravel()
+
+    nxt = np.arange(n + 1, dtype=dtype)
+    for k, (dv, dh) in offsets.items():
+        sel = flat_indices(flat_fdr == k, dtype)
+        v, h = np.divmod(sel, width)
+        v += dv
+        h += dh
+        inside = (v >= 0) & (v < length) & (h >= 0) & (h < width)
+        nxt[sel] = np.where(inside, v * width + h, n)
+    return nxt
+
+
+def jump_tables(nxt, steps):
+    # jumps[k][c] is the cell reached from c after 2**k moves, for every 2**k <= steps
+    jumps = [nxt]
+    while 2 ** len(jumps) <= steps:
+        jumps.append(jumps[-1][jumps[-1]])
+    return jumps
+
+
+def first_hit(jumps, pos, hit, steps):
+    # Binary lifting: move every droplet in pos forward as far as possible (up to steps moves) without landing
+    # on a cell where hit is True. hit must be closed under moving downstream for this to be exact.
+    # Returns the final positions and the number of moves taken
+    moved = np.zeros(pos.shape, dtype=np.int16)
+    for k in range(len(jumps) - 1, -1, -1):
+        cand = jumps[k][pos]
+        ok = (moved <= steps - 2 ** k) & ~hit[cand]
+        pos = np.where(ok, cand, pos)
+        moved[ok] += 2 ** k
+    return pos, moved
+
+
+def stop_codes(lc_flat):
+    # Code of every cell that ends a walk: water, land cover NODATA and the off-map cell (index n)
+    codes = np.zeros(lc_flat.size + 1, dtype=np.int16)
+    codes[:-1][lc_flat == lc_no_data(lc_flat)] = 6000
+    codes[:-1][(scheme.flags_of(lc_flat) & WATER) > 0] = 1000
+    codes[-1] = 5000
+    return codes
+
+
+def trace_paths(nxt, start, moves):
+    # (len(start) x moves+1) matrix of the cells visited by each droplet, start cell in column 0
+    paths = np.empty((start.size, moves + 1), dtype=nxt.dtype)
+    paths[:, 0] = start
+    for t in range(1, moves + 1):
+        paths[:, t] = nxt[paths[:, t - 1]]
+    return paths
+
+
+def loop_moves(nxt, jumps, start, end, steps):
+    # Move at which each droplet first steps back onto a cell of its own path, given where it is after steps
+    # moves (end). A droplet that loops does so at move mu + lam, where mu is its first move onto the loop and
+    # lam is the loop length. Droplets that do not loop within steps moves get steps + 1
+    ends = np.unique(end)
+    # loop lengths are at most steps, like the move counts of first_hit
+    lam = np.zeros(nxt.size, dtype=np.int16)
+    x = ends
+    found = np.zeros(ends.shape, dtype=bool)
+    for m in range(1, steps + 1):
+        x = nxt[x]
+        new = ~found & (x == ends)
+        lam[ends[new]] = m
+        found |= new
+
+    on_loop = np.zeros(nxt.size, dtype=bool)
+    x = ends[found]
+    for m in range(int(lam.max(initial=0))):
+        on_loop[x] = True
+        x = nxt[x]
+
+    _, mu = first_hit(jumps, start, on_loop, steps)
+    mu = np.where(on_loop[start], 0, mu + 1)
+    repeat = mu + lam[end]
+    return np.where(on_loop[end] & (repeat <= steps), repeat, steps + 1)
+
+
+def keep_table(rates=None):
+    # Fraction of buildup kept per class, 1 - removal rate. rates is a list of (removalrate_forest,
+    # removalrate_nonforest) pairs and gives one row per pair; None gives the single row of the global rates
+    if rates is None:
+        return 1 - scheme.removal_rates(removalrate_forest, removalrate_nonforest)
+    return np.array([1 - scheme.removal_rates(forest, nonforest) for forest, nonforest in rates])
+
+
+def score_paths(classes, n_cells, keep=None):
+    # Buffer width and ag/urban buildup of the first n_cells cells of each path (classes holds the land cover
+    # along the paths, one column per cell), scored exactly like move_on scores seq_list: same operations in
+    # the same order, so the floats match bit for bit.
+    # With a 2-D keep table (see keep_table) agnum and urbnum get a leading scenario axis
+    if keep is None:
+        keep = keep_table()
+    wid = np.zeros(classes.shape[0])
+    agnum = np.zeros(keep.shape[:-1] + classes.shape[:1])
+    urbnum = np.zeros(keep.shape[:-1] + classes.shape[:1])
+    for t in range(int(n_cells.max(initial=0))):
+        active = t < n_cells
+        c = classes[:, t]
+        f = np.where(active, scheme.flags_of(c), 0)
+        is_ag = (f & AG) > 0
+        is_urban = (f & URBAN) > 0
+        is_good = (f & GOOD) > 0
+
+        wid[is_ag | is_urban] = 0.0
+        agnum[..., is_ag] += 1.0
+        urbnum[..., is_urban] += 1.0
+
+        wid[is_good] += 1.0
+        rate = keep[..., c[is_good]]
+        agnum[..., is_good] *= rate
+        urbnum[..., is_good] *= rate
+    return wid, agnum, urbnum
+
+
+def fill_starts(hydist, buffwid, start, code, dist, wid):
+    # hydist and buffwid of the start cells (flat arrays). wid belongs to the starts with code 1000
+    hydist[start] = np.where(np.isin(code, (1000, 4000)), dist, code)
+    buffwid[start] = np.where(code == 1000, 0, code)
+    buffwid[start[code == 1000]] = wid
+
+
+def fill_outputs(outputs, start, code, dist, wid, agnum, urbnum, last):
+    # Write the per-start results into the output arrays. wid/agnum/urbnum/last belong to the starts with
+    # code 1000 (reached water), in start order
+    fill_starts(outputs['hydist'].ravel(), outputs['buffwid'].ravel(), start, code, dist, wid)
+    return fill_stream_cells(outputs, wid, agnum, urbnum, last)
+
+
+def fill_stream_cells(outputs, wid, agnum, urbnum, last):
+    # Per-cell reductions over the stream-adjacent cell (flat index `last`) of each start that reached water:
+    # buffwidmax is the widest buffer draining to the cell, buildup the summed buildup of those starts
+    buffwidmax = outputs['buffwidmax'].ravel()
+    np.maximum.at(buffwidmax, last, wid.astype(buffwidmax.dtype))
+    return fill_buildup(outputs, agnum, urbnum, last)
+
+
+def fill_buildup(outputs, agnum, urbnum, last):
+    touched, ag_sum, urban_sum = buildup_sums(agnum, urbnum, last)
+    outputs['buildup_ag'].ravel()[touched] = ag_sum
+    outputs['buildup_urban'].ravel()[touched] = urban_sum
+    outputs['buildup_ag_and_urban'].ravel()[touched] = ag_sum + urban_sum
+    return outputs
+
+
+def buildup_sums(agnum, urbnum, last):
+    # Sum buildup per stream-adjacent cell in start-cell order (bincount adds its weights sequentially)
+    touched, cell = np.unique(last, return_inverse=True)
+    ag_sum = np.bincount(cell, weights=agnum, minlength=touched.size)
+    urban_sum = np.bincount(cell, weights=urbnum, minlength=touched.size)
+    return touched, ag_sum, urban_sum
+
+
+def compact_outputs(shape, start, code, dist, wid, agnum, urbnum, last):
+    # Compact version of fill_outputs: int16 hydist/buffwid/buffwidmax and buildup kept only for the stream-adjacent
+    # cells, as float32. The buildup values are truncated to whole numbers first, like the Int32 rasters they end up
+    # in, so float32 holds them exactly (they are nowhere near 2**24)
+    hydist = np.full(shape, no_data, dtype=np.int16)
+    buffwid = np.full(shape, no_data, dtype=np.int16)
+    buffwidmax = np.full(shape, -999, dtype=np.int16)
+    fill_starts(hydist.ravel(), buffwid.ravel(), start, code, dist, wid)
+    np.maximum.at(buffwidmax.ravel(), last, wid.astype(np.int16))
+    return {'hydist': hydist, 'buffwid': buffwid, 'buffwidmax': buffwidmax,
+            'buildup': compact_buildup(agnum, urbnum, last)}
+
+
+def compact_buildup(agnum, urbnum, last):
+    touched, ag_sum, urban_sum = buildup_sums(agnum, urbnum, last)
+    return {
+        'cells': touched,
+        'buildup_ag': np.trunc(ag_sum).astype(np.float32),
+        'buildup_urban': np.trunc(urban_sum).astype(np.float32),
+        'buildup_ag_and_urban': np.trunc(ag_sum + urban_sum).astype(np.float32),
+        }
+
+
+def assemble_outputs(shape, resolved, compact=False):
+    # Output arrays from an engine's per-start results, full int64 rasters or the compact layout
+    if compact:
+        return compact_outputs(shape, *resolved)
+    return fill_outputs(empty_outputs(shape), *resolved)
+
+
+def assemble_scenarios(shape, resolved, compact=False):
+    # One outputs dict per scenario from per-start results scored with a 2-D keep table (agnum and urbnum have a
+    # leading scenario axis). The rate-independent hydist/buffwid/buffwidmax arrays are shared by all scenarios
+    start, code, dist, wid, agnum, urbnum, last = resolved
+    first = assemble_outputs(shape, (start, code, dist, wid, agnum[0], urbnum[0], last), compact)
+    results = [first]
+    for ag_s, urban_s in zip(agnum[1:], urbnum[1:]):
+        outputs = {o: first[o] for o in ('hydist', 'buffwid', 'buffwidmax')}
+        if compact:
+            outputs['buildup'] = compact_buildup(ag_s, urban_s, last)
+        else:
+            for o in ('buildup_ag', 'buildup_urban', 'buildup_ag_and_urban'):
+                outputs[o] = np.full(shape, no_data)
+            fill_buildup(outputs, ag_s, urban_s, last)
+        results.append(outputs)
+    return results
+
+
+def output_array(outputs, o):
+    # One output raster as a full array, expanding the sparse buildup of compact outputs
+    if o in outputs:
+        return outputs[o]
+    buildup = outputs['buildup']
+    arr = np.full(outputs['hydist'].shape, no_data, dtype=np.int32)
+    arr.ravel()[buildup['cells']] = buildup[o]
+    return arr
+
+
+def memory_report(label, arrays):
+    # Bytes held by each array (sparse buildup included) and the peak resident memory of the process so far
+    def nbytes(a):
+        if isinstance(a, dict):
+            return sum(nbytes(v) for v in a.values())
+        if isinstance(a, list):
+            return sum(nbytes(v) for v in a)
+        if isinstance(a, PackedMask):
+            return a.bits.nbytes
+        return getattr(a, 'nbytes', 0)
+
+    total = 0
+    print(f"Memory use, {label}:")
+    for name, a in arrays.items():
+        total += nbytes(a)
+        print(f"  {name:<22} {nbytes(a) / 2**20:10.1f} MB")
+    print(f"  {'total':<22} {total / 2**20:10.1f} MB")
+    peak = peak_rss_mb()
+    if peak is not None:
+        print(f"  {'peak RSS':<22} {peak:10.1f} MB")
+
+
+def trace_length(flow_length=None):
+    # Number of cells the paths are traced to: flow_length, or max_flow_length when it isn't given
+    return max_flow_length if flow_length is None else flow_length
+
+
+def resolve_vectorized(lc, fdr, dist_mask, fdr_no_data, keep=None, flow_length=None):
+    # Whole-grid engine: builds the "next cell" index once and resolves the terminal code and hydist of every
+    # start cell with pointer doubling instead of walking one cell at a time.
+    # Returns the per-start results that fill_outputs turns into rasters (keep: see score_paths; flow_length: the
+    # cutoff to trace to, max_flow_length by default)
+    flow_length = trace_length(flow_length)
+    steps = flow_length + 1   # move_on inspects at most this many cells downstream of the start
+    lc_flat = lc.ravel()
+
+    # Stop cells point at themselves so that "has stopped" stays true once reached
+    codes = stop_codes(lc_flat)
+    is_stop = codes > 0
+    nxt = next_cell_index(fdr)
+    nxt[is_stop] = flat_indices(is_stop, nxt.dtype)
+    jumps = jump_tables(nxt, steps)
+
+    start = flat_indices(start_cells(lc, fdr, dist_mask, fdr_no_data), nxt.dtype)
+    pos, dist = first_hit(jumps, start, is_stop, steps)
+    reached = dist < steps
+    dist += 1                             # cells walked before the stop cell, i.e. len(seq_list)
+    code = np.where(reached, codes[nxt[pos]], np.int16(2000))
+
+    # Stops found exactly one cell past flow_length only count when they are the map edge (move_on checks
+    # the edge before the length)
+    code[reached & (dist > flow_length) & (code != 5000)] = 2000
+
+    # Droplets that never stop within the cutoff may have looped back onto their own path
+    looping = np.flatnonzero(~reached)
+    repeat = loop_moves(nxt, jumps, start[looping], pos[looping], steps)
+    del pos
+    cyclic = repeat <= steps
+    code[looping[cyclic]] = 4000
+    dist[looping[cyclic]] = repeat[cyclic]
+
+    # Score the paths that reached water
+    wet = code == 1000
+    paths = trace_paths(nxt, start[wet], flow_length - 1)
+    wid, agnum, urbnum = score_paths(lc_flat[paths], dist[wet], keep)
+    last = paths[np.arange(paths.shape[0]), dist[wet] - 1]
+
+    return start, code, dist, wid, agnum, urbnum, last
+
+
+def traverse_vectorized(lc, fdr, dist_mask, fdr_no_data):
+    return fill_outputs(empty_outputs(lc.shape), *resolve_vectorized(lc, fdr, dist_mask, fdr_no_data))
+
+
+def path_stop_codes(lc_flat, path):
+    # stop_codes and land cover of the cells in path (flat indices, n off the map), without codes for the whole grid
+    n = lc_flat.size
+    off_map = path == n
+    lc_path = lc_flat[np.where(off_map, 0, path)]
+    lc_path[off_map] = lc_no_data(lc_flat)
+    codes = np.zeros(path.shape, dtype=np.int16)
+    codes[lc_path == lc_no_data(lc_flat)] = 6000
+    codes[(scheme.flags_of(lc_path) & WATER) > 0] = 1000
+    codes[off_map] = 5000
+    return codes, lc_path
+
+
+def resolve_paths(lc_flat, path, repeat, flow_length, keep=None):
+    # Per-start results (without the starts) of walks traced through the fdr alone: path holds the start cell and the
+    # flow_length+1 cells below it (n once off the map) and repeat the move at which the walk loops (see loop_moves).
+    # This year's water and NODATA end the walks here
+    steps = flow_length + 1
+    row_idx = np.arange(path.shape[0])
+
+    # First cell past the start that stops the walk, i.e. len(seq_list)
+    hit, classes = path_stop_codes(lc_flat, path)
+    hit[:, 0] = 0
+    reached = (hit > 0).any(axis=1)
+    dist = np.where(reached, (hit > 0).argmax(axis=1), steps + 1).astype(np.int16)
+    code = np.where(reached, hit[row_idx, np.minimum(dist, steps)], np.int16(2000))
+    code[reached & (dist > flow_length) & (code != 5000)] = 2000
+
+    cyclic = ~reached & (repeat <= steps)
+    code[cyclic] = 4000
+    dist[cyclic] = repeat[cyclic]
+
+    wet = code == 1000
+    wid, agnum, urbnum = score_paths(classes[wet], dist[wet], keep)
+    last = path[wet][row_idx[:wet.sum()], dist[wet] - 1]
+    return code, dist, wid, agnum, urbnum, last
+
+
+def traverse_years(lcs, fdr, dist_masks, fdr_no_data, compact=False, rates=None, cutoffs=flow_lengths, metrics=None):
+    # Multi-year engine. fdr is the same for every year of a basin, so the downstream path of every start cell
+    # is traced once into an (N cells x max(cutoffs)+1) index matrix, and each year's land cover is then
+    # gathered through that matrix and scored with vectorized scans. Returns one outputs dict per year, or with
+    # a list of removal-rate pairs, results[cutoff][scenario] per year (see traverse_scenarios). The paths are traced
+    # to the longest cutoff
+    flow_length = max(cutoffs)
+    steps = flow_length + 1
+    with stage(metrics, 'traverse', profile=True):
+        starts = [start_cells(lc, fdr, m, fdr_no_data).ravel() for lc, m in zip(lcs, dist_masks)]
+        # Only the map edge stops a path here; water and NODATA depend on the year and are applied per year
+        nxt = next_cell_index(fdr)
+        candidates = flat_indices(np.logical_or.reduce(starts), nxt.dtype)
+        paths = trace_paths(nxt, candidates, flow_length)
+        end = nxt[paths[:, -1]]
+        repeat = loop_moves(nxt, jump_tables(nxt, steps), candidates, end, steps)
+
+    results = []
+    for lc, year_start in zip(lcs, starts):
+        with stage(metrics, 'traverse'):
+            rows = flat_indices(year_start[candidates], candidates.dtype)
+            path = np.column_stack([paths[rows], end[rows]])
+            code, dist, wid, agnum, urbnum, last = resolve_paths(lc.ravel(), path, repeat[rows], flow_length,
+                                                                 keep_table(rates))
+        if metrics is not None:
+            metrics.count_starts(code, dist)
+
+        resolved = (candidates[rows], code, dist, wid, agnum, urbnum, last)
+        with stage(metrics, 'buildup'):
+            if rates is None:
+                results.append(assemble_outputs(lc.shape, resolved, compact))
+            else:
+                results.append(assemble_sweep(lc.shape, resolved, cutoffs, compact))
+    return results
+
+
+def resolve_numba(lc, fdr, dist_mask, fdr_no_data, keep=None, flow_length=None, start=None):
+    # Per-cell walk compiled with numba; same results as traverse_recursive (keep: see score_paths). start limits the
+    # walks to those (sorted flat) start cells
+    if keep is None:
+        keep = keep_table()
+    if start is None:
+        start = np.flatnonzero(start_cells(lc, fdr, dist_mask, fdr_no_data))
+    code, dist, wid, agnum, urbnum, last = walk_cells(
+        lc, fdr, start, scheme.flags, keep.reshape(-1, keep.shape[-1]), lc_no_data(lc), trace_length(flow_length))
+    wet = code == 1000
+    agnum = agnum[:, wet].reshape(keep.shape[:-1] + (-1,))
+    urbnum = urbnum[:, wet].reshape(keep.shape[:-1] + (-1,))
+    return start, code, dist, wid[wet], agnum, urbnum, last[wet]
+
+
+def traverse_numba(lc, fdr, dist_mask, fdr_no_data):
+    return fill_outputs(empty_outputs(lc.shape), *resolve_numba(lc, fdr, dist_mask, fdr_no_data))
+
+
+def resolve(lc, fdr, dist_mask, fdr_no_data, engine='vectorized', keep=None, flow_length=None):
+    # Per-start results from one of the engines that produce them (vectorized or numba), traced to flow_length
+    # (max_flow_length by default)
+    if engine == 'numba':
+        if walk_cells is not None:
+            return resolve_numba(lc, fdr, dist_mask, fdr_no_data, keep, flow_length)
+        print("numba is not installed, falling back to the vectorized engine")
+        engine = 'vectorized'
+    if engine == 'vectorized':
+        return resolve_vectorized(lc, fdr, dist_mask, fdr_no_data, keep, flow_length)
+    raise ValueError(f"Engine '{engine}' can't be used here, expected 'vectorized' or 'numba'")
+
+
+def band_height(width, memory_limit_mb, flow_length=None):
+    # Rows per band of the streaming mode so that a band and its halo stay under memory_limit_mb
+    halo = trace_length(flow_length) + 1
+    rows = int(memory_limit_mb * 2**20 // (width * stream_bytes_per_cell)) - 2 * halo
+    if rows < 1:
+        raise MemoryError(f"memory_limit_mb={memory_limit_mb} is too small for {width} columns with a {halo}-row halo")
+    return rows
+
+
+def traverse_bands(read_window, shape, fdr_no_data, band_rows, engine='vectorized', flow_length=None, metrics=None):
+    # Streaming engine for rasters that don't fit in memory. Works through band_rows rows at a time, reading each
+    # band with a halo of flow_length+1 rows above and below (max_flow_length by default) so every path started in
+    # the band stays inside the window. read_window(row, rows) returns the (lc, fdr, dist_mask) arrays of rows
+    # [row, row+rows).
+    #
+    # Yields (output name, first row, block) as soon as a block is final: hydist and buffwid for each band,
+    # buffwidmax and buildup once no later band can flow into those rows any more. Buildup is added up in the same
+    # start-cell order as the whole-grid engines, so the results are identical. With metrics (a RunMetrics record) the
+    # reads, the traversal and the accumulation of every band are timed into it; the caller times its writes
+    length, width = shape
+    flow_length = trace_length(flow_length)
+    halo = flow_length + 1
+
+    # buffwidmax/buildup of the rows that can still receive contributions, starting at acc_row
+    acc_row = 0
+    acc = {
+        'buffwidmax': np.full((0, width), -999),
+        'ag': np.zeros((0, width)),
+        'urban': np.zeros((0, width)),
+        'touched': np.zeros((0, width), dtype=bool),
+        }
+
+    def flush(rows):
+        block = {o: a[:rows] for o, a in acc.items()}
+        for o in acc:
+            acc[o] = acc[o][rows:]
+        bu_ag = block['ag'].astype(np.int64)
+        bu_urban = block['urban'].astype(np.int64)
+        bu_both = (block['ag'] + block['urban']).astype(np.int64)
+        return [
+            ('buffwidmax', block['buffwidmax']),
+            ('buildup_ag', np.where(block['touched'], bu_ag, no_data)),
+            ('buildup_urban', np.where(block['touched'], bu_urban, no_data)),
+            ('buildup_ag_and_urban', np.where(block['touched'], bu_both, no_data)),
+            ]
+
+    for r0 in range(0, length, band_rows):
+        r1 = min(r0 + band_rows, length)
+        w0 = max(r0 - halo, 0)
+        w1 = min(r1 + halo, length)
+        with stage(metrics, 'read'):
+            lc, fdr, dist_mask = read_window(w0, w1 - w0)
+
+        with stage(metrics, 'traverse'):
+            # only start droplets in the band itself
+            dist_mask = dist_mask.copy()
+            dist_mask[:r0 - w0] = 0
+            dist_mask[r1 - w0:] = 0
+            start, code, dist, wid, agnum, urbnum, last = resolve(lc, fdr, dist_mask, fdr_no_data, engine,
+                                                                  flow_length=flow_length)
+        if metrics is not None:
+            metrics.count_starts(code, dist)
+
+        with stage(metrics, 'buildup'):
+            hydist = np.full((r1 - r0, width), no_data)
+            buffwid = np.full((r1 - r0, width), no_data)
+            fill_starts(hydist.ravel(), buffwid.ravel(), start - (r0 - w0) * width, code, dist, wid)
+        yield 'hydist', r0, hydist
+        yield 'buffwid', r0, buffwid
+
+        with stage(metrics, 'buildup'):
+            # grow the accumulators down to the bottom of the window and add this band's contributions
+            grow = w1 - (acc_row + acc['touched'].shape[0])
+            if grow > 0:
+                acc['buffwidmax'] = np.vstack([acc['buffwidmax'], np.full((grow, width), -999)])
+                acc['ag'] = np.vstack([acc['ag'], np.zeros((grow, width))])
+                acc['urban'] = np.vstack([acc['urban'], np.zeros((grow, width))])
+                acc['touched'] = np.vstack([acc['touched'], np.zeros((grow, width), dtype=bool)])
+            cell = last + (w0 - acc_row) * width
+            np.maximum.at(acc['buffwidmax'].ravel(), cell, wid.astype(np.int64))
+            np.add.at(acc['ag'].ravel(), cell, agnum)
+            np.add.at(acc['urban'].ravel(), cell, urbnum)
+            acc['touched'].ravel()[cell] = True
+
+        # later bands start at row r1 or below and their droplets reach water at most flow_length-1 rows up
+        final = length if r1 == length else max(r1 - flow_length, acc_row)
+        for name, block in flush(final - acc_row):
+            yield name, acc_row, block
+        acc_row = final
+
+
+def traverse_tile(lc, fdr, dist_mask, fdr_no_data, core, engine='vectorized', keep=None, flow_length=None):
+    # Worker of the tiled engine. The arrays are a tile plus its halo; core = (row0, row1, col0, col1) is the tile
+    # inside them. Only the tile's own cells are started, the halo just has to be there for their paths
+    row0, row1, col0, col1 = core
+    tile_mask = np.zeros(dist_mask.shape, dtype=dist_mask.dtype)
+    tile_mask[row0:row1, col0:col1] = dist_mask[row0:row1, col0:col1]
+    return resolve(lc, fdr, tile_mask, fdr_no_data, engine, keep, flow_length)
+
+
+def traverse_tiled(lc, fdr, dist_mask, fdr_no_data, workers=None, tile_size=1024, engine='vectorized', compact=False):
+    # Multi-core engine: splits the grid into tile_size x tile_size tiles padded by a max_flow_length+1 halo and
+    # resolves them in a process pool. The per-start results of all tiles are put back in start-cell order before
+    # buffwidmax and buildup are reduced, so the output is bit-identical to a single-process run
+    resolved = resolve_tiled(lc, fdr, dist_mask, fdr_no_data, workers, tile_size, engine)
+    return assemble_outputs(lc.shape, resolved, compact)
+
+
+def resolve_tiled(lc, fdr, dist_mask, fdr_no_data, workers=None, tile_size=1024, engine='vectorized', keep=None,
+                  flow_length=None):
+    # Per-start results of the tiled engine, in start-cell order (keep: see score_paths). The halo is flow_length+1
+    # (max_flow_length by default)
+    length, width = lc.shape
+    flow_length = trace_length(flow_length)
+    halo = flow_length + 1
+    mask = dist_mask.unpack() if isinstance(dist_mask, PackedMask) else dist_mask
+
+    jobs = []
+    with ProcessPoolExecutor(max_workers=workers, mp_context=pool_context) as pool:
+        for r0, c0 in itertools.product(range(0, length, tile_size), range(0, width, tile_size)):
+            r1 = min(r0 + tile_size, length)
+            c1 = min(c0 + tile_size, width)
+            w0, w1 = max(r0 - halo, 0), min(r1 + halo, length)
+            v0, v1 = max(c0 - halo, 0), min(c1 + halo, width)
+            window = (slice(w0, w1), slice(v0, v1))
+            core = (r0 - w0, r1 - w0, c0 - v0, c1 - v0)
+            future = pool.submit(traverse_tile, lc[window], fdr[window], mask[window], fdr_no_data, core, engine, keep,
+                                 flow_length)
+            jobs.append((w0, v0, v1 - v0, future))
+
+        # window-local flat indices -> global flat indices
+        def to_global(local, w0, v0, window_width):
+            rows, cols = np.divmod(local, window_width)
+            return (rows + w0) * width + cols + v0
+
+        parts = []
+        for w0, v0, window_width, future in jobs:
+            start, code, dist, wid, agnum, urbnum, last = future.result()
+            parts.append((to_global(start, w0, v0, window_width), code, dist,
+                          wid, agnum, urbnum, to_global(last, w0, v0, window_width)))
+    return merge_resolved(parts)
+
+
+def merge_resolved(parts):
+    # Combines per-start results of disjoint sets of starts (global flat indices) and puts them in start-cell order
+    start = np.concatenate([p[0] for p in parts])
+    code = np.concatenate([p[1] for p in parts])
+    dist = np.concatenate([p[2] for p in parts])
+    wet_start = np.concatenate([p[0][p[1] == 1000] for p in parts])
+    wid, agnum, urbnum, last = (np.concatenate([p[i] for p in parts], axis=-1) for i in range(3, 7))
+
+    order = np.argsort(start, kind='stable')
+    wet_order = np.argsort(wet_start, kind='stable')
+    return (start[order], code[order], dist[order],
+            wid[wet_order], agnum[..., wet_order], urbnum[..., wet_order], last[wet_order])
+
+
+def flow_graph(fdr, flow_length=None, engine='vectorized'):
+    # What the incremental engine needs of an fdr, built once and reused for every year: the next-cell index, its jump
+    # tables (not needed by the numba walk) and the upstream cells of every cell (upstream[indptr[c]:indptr[c+1]] flow
+    # into c)
+    nxt = next_cell_index(fdr)
+    jumps = None if engine == 'numba' and walk_cells is not None else jump_tables(nxt, trace_length(flow_length) + 1)
+    upstream = np.argsort(nxt[:-1], kind='stable').astype(nxt.dtype)
+    indptr = np.zeros(nxt.size + 1, dtype=np.int64)
+    np.cumsum(np.bincount(nxt[:-1], minlength=nxt.size), out=indptr[1:])
+    return nxt, jumps, upstream, indptr
+
+
+def affected_starts(graph, changed_lc, changed_mask, flow_length=None):
+    # Cells whose walk reads a changed land cover pixel (the cell itself or one of the flow_length+1 cells
+    # downstream of it, the last one deciding the distance of a too-long walk) or whose own flow mask value changed.
+    # Found by walking up from the changed pixels, so the work follows the number of affected cells. Flat bool array
+    _, _, upstream, indptr = graph
+    hit = changed_lc.ravel().copy()
+    frontier = np.flatnonzero(hit)
+    for _ in range(trace_length(flow_length) + 1):
+        lo, counts = indptr[frontier], indptr[frontier + 1] - indptr[frontier]
+        if not counts.any():
+            break
+        offset = np.repeat(lo - (np.cumsum(counts) - counts), counts)
+        cells = upstream[offset + np.arange(offset.size)]
+        frontier = np.unique(cells[~hit[cells]])
+        hit[frontier] = True
+    return hit | changed_mask.ravel()
+
+
+def select_starts(resolved, sel):
+    # The per-start results of the starts where the bool array sel is True
+    start, code, dist, wid, agnum, urbnum, last = resolved
+    wet = sel[code == 1000]
+    return start[sel], code[sel], dist[sel], wid[wet], agnum[..., wet], urbnum[..., wet], last[wet]
+
+
+def insert_resolved(old, new):
+    # merge_resolved for two sets of per-start results that are each in start-cell order: the new starts are inserted
+    # at their place instead of sorting all of them again
+    start, code, dist, wid, agnum, urbnum, last = old
+    n_start, n_code, n_dist, n_wid, n_agnum, n_urbnum, n_last = new
+    at = np.searchsorted(start, n_start)
+    wet_at = np.searchsorted(start[code == 1000], n_start[n_code == 1000])
+    return (np.insert(start, at, n_start), np.insert(code, at, n_code), np.insert(dist, at, n_dist),
+            np.insert(wid, wet_at, n_wid), np.insert(agnum, wet_at, n_agnum, axis=-1),
+            np.insert(urbnum, wet_at, n_urbnum, axis=-1), np.insert(last, wet_at, n_last))
+
+
+def update_resolved(prev, lc, fdr, dist_mask, fdr_no_data, graph, engine='vectorized', keep=None, flow_length=None):
+    # Incremental engine. prev = (lc, dist_mask, per-start results) of an earlier year on the same fdr and graph its
+    # flow_graph. Only the starts whose walk can differ between the years are resolved again, by walking them with
+    # numba or tracing just their paths; the others keep their earlier results.
+    # Returns the per-start results for this year and the flat mask of the re-resolved cells
+    prev_lc, prev_mask, prev_resolved = prev
+    flow_length = trace_length(flow_length)
+    nxt, jumps, _, _ = graph
+    mask = dist_mask.unpack() if isinstance(dist_mask, PackedMask) else dist_mask != 0
+    old_mask = prev_mask.unpack() if isinstance(prev_mask, PackedMask) else prev_mask != 0
+    affected = affected_starts(graph, prev_lc != lc, old_mask != mask, flow_length)
+
+    # the start cells among the affected ones
+    lc_flat = lc.ravel()
+    cells = flat_indices(affected, nxt.dtype)
+    start = cells[start_cells(lc_flat[cells], fdr.ravel()[cells], mask.ravel()[cells], fdr_no_data)]
+    if engine == 'numba' and walk_cells is not None:
+        new = resolve_numba(lc, fdr, None, fdr_no_data, keep, flow_length, start)
+    else:
+        paths = trace_paths(nxt, start, flow_length)
+        end = nxt[paths[:, -1]]
+        repeat = loop_moves(nxt, jumps, start, end, flow_length + 1)
+        new = (start,) + resolve_paths(lc_flat, np.column_stack([paths, end]), repeat, flow_length, keep)
+
+    old = select_starts(prev_resolved, ~affected[prev_resolved[0]])
+    return insert_resolved(old, new), affected
+
+
+def patched_streams(prev_resolved, resolved, affected):
+    # The stream-adjacent cells that an affected start drained to before or drains to now, and which of the wet
+    # starts of resolved drain to one of them
+    p_start, p_code, _, _, _, _, p_last = prev_resolved
+    start, code, _, _, _, _, last = resolved
+    stream = np.union1d(p_last[affected[p_start[p_code == 1000]]], last[affected[start[code == 1000]]])
+    in_stream = np.zeros(affected.size, dtype=bool)
+    in_stream[stream] = True
+    return stream, in_stream[last]
+
+
+def patch_outputs(outputs, prev_resolved, resolved, affected, widths=True, streams=None):
+    # Brings outputs of prev_resolved up to date with resolved, which only differs from it at the affected starts:
+    # hydist/buffwid are rewritten at the affected cells, buffwidmax and buildup at the stream-adjacent cells that an
+    # affected start drained to before or drains to now, from all the starts draining to those cells (in start
+    # order, so the sums match a full recompute). widths=False only patches the buildup. streams: patched_streams of
+    # the two results, when already known
+    start, code, dist, wid, agnum, urbnum, last = resolved
+    stream, draining = patched_streams(prev_resolved, resolved, affected) if streams is None else streams
+
+    if widths:
+        hydist = outputs['hydist'].ravel()
+        buffwid = outputs['buffwid'].ravel()
+        cells = np.flatnonzero(affected)
+        hydist[cells] = no_data
+        buffwid[cells] = no_data
+        sel = affected[start]
+        fill_starts(hydist, buffwid, start[sel], code[sel], dist[sel], wid[sel[code == 1000]])
+
+        buffwidmax = outputs['buffwidmax'].ravel()
+        buffwidmax[stream] = -999
+        np.maximum.at(buffwidmax, last[draining], wid[draining].astype(buffwidmax.dtype))
+
+    if 'buildup' in outputs:
+        # compact layout: the sparse buildup's entries at the stream cells are replaced
+        outputs['buildup'] = patch_compact_buildup(outputs['buildup'], stream, agnum[draining], urbnum[draining],
+                                                   last[draining])
+    else:
+        for o in ('buildup_ag', 'buildup_urban', 'buildup_ag_and_urban'):
+            outputs[o].ravel()[stream] = no_data
+        fill_buildup(outputs, agnum[draining], urbnum[draining], last[draining])
+    return outputs
+
+
+def patch_compact_buildup(buildup, stream, agnum, urbnum, last):
+    # compact_buildup with the entries of the stream cells recomputed from the starts draining to them (in start
+    # order) and the other entries kept
+    kept = ~np.isin(buildup['cells'], stream)
+    new = compact_buildup(agnum, urbnum, last)
+    at = np.searchsorted(buildup['cells'][kept], new['cells'])
+    return {o: np.insert(buildup[o][kept], at, new[o]) for o in buildup}
+
+
+def patch_sweep(results, prev_resolved, resolved, affected, cutoffs):
+    # patch_outputs for every cutoff and scenario of assemble_sweep's results[cutoff][scenario]. The scenarios of a
+    # cutoff share hydist/buffwid/buffwidmax and the patched stream cells, so those are only patched/found once.
+    # Only the starts that patch_outputs reads are limited to each cutoff: the affected ones and those draining to a
+    # stream cell patched at the longest cutoff (a shorter cutoff patches some of those)
+    stream, _ = patched_streams(prev_resolved, resolved, affected)
+    in_stream = np.zeros(affected.size, dtype=bool)
+    in_stream[stream] = True
+    parts = []
+    for r in (prev_resolved, resolved):
+        sel = affected[r[0]]
+        sel[r[1] == 1000] |= in_stream[r[6]]
+        # copying most of the starts costs more than it saves
+        parts.append(select_starts(r, sel) if np.count_nonzero(sel) < sel.size // 2 else r)
+    for cutoff, cutoff_results in zip(cutoffs, results):
+        prev_c = limit_flow_length(parts[0], cutoff)
+        new_c = limit_flow_length(parts[1], cutoff)
+        streams = patched_streams(prev_c, new_c, affected)
+        for s, outputs in enumerate(cutoff_results):
+            patch_outputs(outputs, prev_c[:4] + (prev_c[4][s], prev_c[5][s], prev_c[6]),
+                          new_c[:4] + (new_c[4][s], new_c[5][s], new_c[6]), affected, s == 0, streams)
+    return results
+
+
+def traverse(lc, fdr, dist_mask, fdr_no_data, engine='vectorized', compact=False):
+    # compact=True returns the compact output layout (see compact_outputs); the recursive engine always returns
+    # full int64 arrays
+    if engine in ('vectorized', 'numba'):
+        # resolve falls back to the vectorized engine when numba is missing
+        return assemble_outputs(lc.shape, resolve(lc, fdr, dist_mask, fdr_no_data, engine), compact)
+    if engine == 'recursive':
+        return traverse_recursive(lc, fdr, dist_mask, fdr_no_data)
+    raise ValueError(f"Unknown traversal engine '{engine}', expected one of {engines}")
+
+
+def limit_flow_length(resolved, cutoff):
+    # Per-start results for a cutoff shorter than the length the paths were traced to, from those results.
+    # move_on checks a cell for a cycle and the map edge before the length, so those stops still count one cell past
+    # the cutoff; every other stop further than the cutoff becomes 2000. Paths that are kept are scored the same
+    start, code, dist, wid, agnum, urbnum, last = resolved
+    limit = np.where((code == 4000) | (code == 5000), cutoff + 1, cutoff)
+    kept = dist[code == 1000] <= cutoff
+    code = np.where(dist <= limit, code, 2000).astype(code.dtype)
+    if kept.all():
+        # the cutoff the paths were traced to
+        return start, code, dist, wid, agnum, urbnum, last
+    return start, code, dist, wid[kept], agnum[..., kept], urbnum[..., kept], last[kept]
+
+
+def assemble_sweep(shape, resolved, cutoffs, compact=False):
+    # Outputs of every cutoff and scenario from one set of per-start results: results[cutoff][scenario]
+    return [assemble_scenarios(shape, limit_flow_length(resolved, cutoff), compact) for cutoff in cutoffs]
+
+
+def stage(metrics, name, profile=False):
+    # Times a stage into metrics (a RunMetrics record) when there is one
+    return metrics.stage(name, profile) if metrics is not None else nullcontext()
+
+
+def traverse_scenarios(lc, fdr, dist_mask, fdr_no_data, rates, engine='vectorized', workers=1, tile_size=1024,
+                       compact=False, cutoffs=flow_lengths, metrics=None):
+    # Traces the paths once to the longest cutoff and scores them for every (removalrate_forest, removalrate_nonforest)
+    # pair in rates and every flow length cutoff in cutoffs. Returns results[cutoff][scenario].
+    # The recursive engine can't do this; it is replaced by the vectorized one
+    if engine == 'recursive':
+        engine = 'vectorized'
+    with stage(metrics, 'traverse', profile=True):
+        if workers > 1:
+            resolved = resolve_tiled(lc, fdr, dist_mask, fdr_no_data, workers, tile_size, engine, keep_table(rates),
+                                     max(cutoffs))
+        else:
+            resolved = resolve(lc, fdr, dist_mask, fdr_no_data, engine, keep_table(rates), max(cutoffs))
+    if metrics is not None:
+        metrics.count_starts(resolved[1], resolved[2])
+    with stage(metrics, 'buildup'):
+        return assemble_sweep(lc.shape, resolved, cutoffs, compact)
+
+
+def input_files(basin, year):
+    # Input files
+    # # These files MUST BE FULLY ALIGNED; exact same dimensions, pixel size, etc
+    # cd = "/net/nas3/data/gis_lab/project/MDNR_Phragmites/landscape_modeling/code/traversability/inputs/"
+    # fdr_file = os.path.join(cd,"fdr10m_clipped.tif")  # flow direction
+    # lc_file = os.path.join(cd,"lc_laura_resample2_clipped.tif")  # land cover, ccap, original classification
+    # dist_mask_file = os.path.join(cd, 'nhd_linear_cleaned_200m_dist_mask_resample_clipped.tif')
+    #"D:\Ashok\Catskills_Project\Inputs\West_Delaware\LULC_10m_2021.tif"
+
+    LULC=fr"D:\Ashok\Catskills_Project\Inputs\{basin}\{basin}_LULC_10m_{year}.tif"
+    FDR=fr"D:\Ashok\Catskills_Project\Inputs\{basin}\FDR_10m.tif"
+    buffer_mask=fr"D:\Ashok\Catskills_Project\Inputs\{basin}\{basin}_{year}_Flow_Mask_200m.tif"
+    return LULC, FDR, buffer_mask
+
+
+def read_fdr(fdr_file):
+    if cache_dir:
+        fdr, meta = read_cached(fdr_file, cache_dir)
+        print(f"Flow direction shape: {fdr.shape}")
+        return fdr, meta['nodata']
 
     fdr_ds = gdal.Open(fdr_file, 0)
     fdr = fdr_ds.ReadAsArray()
     fdr_no_data = fdr_ds.GetRasterBand(1).GetNoDataValue()
     del fdr_ds
+    print(f"Flow direction shape: {fdr.shape}")
+    return fdr, fdr_no_data
 
-    #bew = gdal.Open(bew_file, 0).ReadAsArray()
 
-    # open distance mask
-    dist_mask_ds = gdal.Open(dist_mask_file,0)
-    dist_mask = dist_mask_ds.ReadAsArray()
-    del dist_mask_ds
+def read_year(lc_file, dist_mask_file):
+    ### Open each input file - flow direction and land cover, and read those lines
+    if cache_dir:
+        # memory-mapped from the input cache
+        lc, meta = read_cached(lc_file, cache_dir)
+        driver = gdal.GetDriverByName(meta['driver'])
+        geotransform = tuple(meta['geotransform'])
+        projection = meta['projection']
+        dist_mask, _ = read_cached(dist_mask_file, cache_dir)
+    else:
+        lc_ds = gdal.Open(lc_file, 0)
+        driver = lc_ds.GetDriver()
+        geotransform = lc_ds.GetGeoTransform()
+        projection = lc_ds.GetProjection()
+        lc = lc_ds.ReadAsArray()
+        del lc_ds
+
+        #bew = gdal.Open(bew_file, 0).ReadAsArray()
+
+        # open distance mask
+        dist_mask_ds = gdal.Open(dist_mask_file,0)
+        dist_mask = dist_mask_ds.ReadAsArray()
+        del dist_mask_ds
+
+    print ('length: {}, width: {}'.format(*lc.shape))
+    print(f"Land cover shape: {lc.shape}")
+    print(f"Distance mask shape: {dist_mask.shape}")
+    return lc, dist_mask, (driver, geotransform, projection)
 
-    shape = lc.shape
-    length = shape[0]
-    width = shape[1]
 
-    print ('length: {}, width: {}'.format(length, width))
+def create_output(basin, output_prefix, o, shape, georef, options=gtiff_options):
+    driver, geotransform, projection = georef
 
-    print(f"Land cover shape: {lc.shape}")
-    print(f"Flow direction shape: {fdr.shape}")
-    print(f"Distance mask shape: {dist_mask.shape}")
+    # ensure the Outputs directory exists
+    out_dir = os.path.join(wd, "Outputs",basin)
+    os.makedirs(out_dir, exist_ok=True)
 
-    # Open each output file, write the header rows, change the NODATA value (change it from '-9999' to '999' just to save space...), and close
-    hydist = np.full(lc.shape, no_data)
-    buffwid = np.full(lc.shape, no_data)
-    buffwidmax = np.full(lc.shape, -999)
-    bu_ag = np.full(lc.shape, no_data)
-    bu_urban = np.full(lc.shape, no_data)
-    bu_both = np.full(lc.shape, no_data)
+    outfl = os.path.join(out_dir, f"{output_prefix}_{o}.tif")
+    print(outfl)
 
-    start = dt.now()
-    for (i,j) in np.ndindex(lc.shape):
-        if i % 250 == 0 and j==0:   # Print every 250 rows
-            print(f"Processing row {i} of {length} ({100 * i / length:.1f}%)")
-        if fdr[i,j] in (fdr_no_data,0)  or lc[i,j] == no_data:  # if a background value is encountered, write that to the output files
-            for o in [hydist, buffwid]:
-                o[i,j] = no_data
+    outDs = driver.Create(
+        outfl,
+        shape[1],
+        shape[0], 1, GDT_Int32,
+        options=options
+    )
+    if outDs is None:
+        print('Could not create output file - bad path?')
+        sys.exit(1)
 
-        elif lc[i,j] in water_values:  # if a water value is encountered, write '0'
-            for o in [hydist, buffwid]:
-                o[i,j] = no_data
+    # set the NoData value
+    outDs.GetRasterBand(1).SetNoDataValue(output_no_data(o))
 
-        elif not dist_mask[i,j]:
-            for o in [hydist, buffwid]:
-                o[i,j] = no_data
+    # georeference the image and set the projection
+    outDs.SetGeoTransform(geotransform)
+    outDs.SetProjection(projection)
+    return outDs, outfl
 
-        # otherwise, reset tracking variables and run the sequencer program to acquire the hydrologic traversability sequence
-        else:
-            seq_list = [lc[i,j]]
-            bew_list = []#[bew[i,j]]
-            history = [(i,j)]
-            sequencer(fdr[i,j], seq_list, bew_list, i, j, history)
 
-    print('Processing time: {}'.format(dt.now() - start))
+def output_no_data(o):
+    return -999 if o == 'buffwidmax' else no_data
 
-    # Build buildup arrays
-    for b in buildup:
-        if buildup[b]['ag'] >= 0:
-            bu_ag[b] = buildup[b]['ag']
-        if buildup[b]['urban'] >= 0:
-            bu_urban[b] = buildup[b]['urban']
-        bu_both[b] = buildup[b]['ag'] + buildup[b]['urban']
-
-    # Write output files
-    for o,v in {
-            'hydist': hydist,
-            'buffwid' : buffwid,
-            'buffwidmax': buffwidmax,
-            'buildup_ag': bu_ag,
-            'buildup_urban': bu_urban,
-            'buildup_ag_and_urban': bu_both
-            }.items():
-
-        # ensure the Outputs directory exists
-        out_dir = os.path.join(wd, "Outputs",basin)
-        os.makedirs(out_dir, exist_ok=True)
 
-        outfl = os.path.join(out_dir, f"{output_prefix}_{o}.tif")
-        print(outfl)
+def write_outputs(outputs, basin, output_prefix, georef, metrics=None):
+    # Queues the outputs on the background writer. The arrays must not change until writer.wait() has returned
+    writer.submit(output_prefix, write_now, outputs, basin, output_prefix, georef, output_layout, metrics)
 
-        
-        outDs = driver.Create(
-            outfl,
-            lc.shape[1],
-            lc.shape[0], 1, GDT_Int32,
-            options=['COMPRESS=LZW']
-        )
-        if outDs is None:
-            print('Could not create output file - bad path?')
-            sys.exit(1)
 
+def write_now(outputs, basin, output_prefix, georef, layout='separate', metrics=None):
+    with stage(metrics, 'write'):
+        write_files(outputs, basin, output_prefix, georef, layout)
+
+
+def write_files(outputs, basin, output_prefix, georef, layout='separate'):
+    # Write output files (full or compact outputs; compact buildup is expanded one raster at a time)
+    shape = outputs['hydist'].shape
+    if layout != 'separate':
+        _, geotransform, projection = georef
+        out_dir = os.path.join(wd, "Outputs", basin)
+        os.makedirs(out_dir, exist_ok=True)
+        outfl = os.path.join(out_dir, f"{output_prefix}_outputs.tif")
+        write_bands(outfl, shape, [(o, output_no_data(o)) for o in output_names], lambda o: output_array(outputs, o),
+                    geotransform, projection, cog=layout == 'cog')
+        print(f"Created {outfl}")
+        return
+
+    for o in output_names:
+        v = output_array(outputs, o)
+        outDs, outfl = create_output(basin, output_prefix, o, shape, georef)
         outBand = outDs.GetRasterBand(1)
 
-        # write the data
+        # write the data and flush it to disk
         outBand.WriteArray(v, 0, 0)
-
-        # flush data to disk, set the NoData value and calculate stats
         outBand.FlushCache()
-        if o == 'buffwidmax':
-            outBand.SetNoDataValue(-999)  
+        del outDs, v
+        print(f"Created {outfl}")
+
+
+def write_sweep(results, basin, year, georef, scenarios, cutoffs, metrics=None):
+    # Writes results[cutoff][scenario]. The cutoff (in map units) is only added to the file names when there are several
+    cell_size = abs(georef[1][1])
+    for cutoff, cutoff_results in zip(cutoffs, results):
+        tag = f'{cutoff * cell_size:g}m_' if len(cutoffs) > 1 else ''
+        for (name, _, _), outputs in zip(scenarios, cutoff_results):
+            write_outputs(outputs, basin, f'{name}_{basin}_{year}_{tag}', georef, metrics)
+
+
+def run_metrics(label, basin, mode, engine, **values):
+    metrics = RunMetrics(label, profile_dir)
+    metrics.values.update(basin=basin, mode=mode, engine=engine, **values)
+    return metrics
+
+
+def metrics_json(basin, label):
+    return os.path.join(wd, "Outputs", basin, f"{label}_metrics.json")
+
+
+def save_metrics(metrics, basin, add_to_csv=True):
+    # Queued behind the run's writes, so the write stage is complete when the record is saved
+    writer.submit(f"{metrics.label} metrics", metrics.save, metrics_json(basin, metrics.label),
+                  metrics_file if add_to_csv else None)
+
+
+def traversibility_algorithm(basin,year,engine='vectorized',workers=1,tile_size=1024,compact=True,scenarios=scenarios,
+                             cutoffs=flow_lengths):
+    # scenarios: (output prefix, removalrate_forest, removalrate_nonforest) triples and cutoffs: flow lengths, all
+    # scored from one path trace to the longest
+    lc_file, fdr_file, dist_mask_file = input_files(basin, year)
+    rates = [(forest, nonforest) for _, forest, nonforest in scenarios]
+
+    ########################################################
+    ##################### MAIN PROGRAM #####################
+    ########################################################
+
+    metrics = run_metrics(f"{basin}_{year}", basin, 'single', engine, year=year, workers=workers)
+    with metrics.stage('read'):
+        fdr, fdr_no_data = read_fdr(fdr_file)
+        lc, dist_mask, georef = read_year(lc_file, dist_mask_file)
+    metrics.values['cells'] = lc.size
+    with metrics.stage('mask'):
+        if compact:
+            lc, fdr, dist_mask, fdr_no_data = compact_inputs(lc, fdr, dist_mask, fdr_no_data)
+
+    start = dt.now()
+    results = traverse_scenarios(lc, fdr, dist_mask, fdr_no_data, rates, engine, workers, tile_size, compact, cutoffs,
+                                 metrics)
+    print('Processing time: {}'.format(dt.now() - start))
+    memory_report(f"{basin}-{year}", {'lc': lc, 'fdr': fdr, 'dist_mask': dist_mask, 'outputs': results})
+
+    write_sweep(results, basin, year, georef, scenarios, cutoffs, metrics)
+    save_metrics(metrics, basin)
+
+
+def traversibility_years(basin, years, compact=True, scenarios=scenarios, cutoffs=flow_lengths):
+    # Multi-year mode: reads the basin's FDR once and scores every year, scenario and cutoff from a single path trace.
+    # The stages are shared by the years, so there is one metrics record for the basin
+    metrics = run_metrics(f"{basin}_{years[0]}-{years[-1]}", basin, 'multi_year', 'vectorized', year=years[-1])
+    fdr_file = input_files(basin, years[0])[1]
+    with metrics.stage('read'):
+        fdr, fdr_no_data = read_fdr(fdr_file)
+    with metrics.stage('mask'):
+        if compact:
+            fdr, fdr_no_data = compact_fdr(fdr, fdr_no_data)
+
+    lcs, dist_masks, georefs = [], [], []
+    for year in years:
+        lc_file, _, dist_mask_file = input_files(basin, year)
+        with metrics.stage('read'):
+            lc, dist_mask, georef = read_year(lc_file, dist_mask_file)
+        with metrics.stage('mask'):
+            if compact:
+                lc, dist_mask = compact_lc(lc), PackedMask(dist_mask)
+        lcs.append(lc)
+        dist_masks.append(dist_mask)
+        georefs.append(georef)
+    metrics.values['cells'] = lcs[0].size * len(years)
+
+
+    start = dt.now()
+    rates = [(forest, nonforest) for _, forest, nonforest in scenarios]
+    results = traverse_years(lcs, fdr, dist_masks, fdr_no_data, compact, rates, cutoffs, metrics)
+    print('Processing time: {}'.format(dt.now() - start))
+    memory_report(basin, {'lc': lcs, 'fdr': fdr, 'dist_mask': dist_masks, 'outputs': results})
+
+    for year, year_results, georef in zip(years, results, georefs):
+        write_sweep(year_results, basin, year, georef, scenarios, cutoffs, metrics)
+    save_metrics(metrics, basin)
+
+
+def traversibility_incremental(basin, years, engine='vectorized', compact=True, scenarios=scenarios, cutoffs=flow_lengths):
+    # Incremental mode: the first year is resolved in full, every later year only re-resolves the starts whose walk
+    # reads a land cover pixel that changed since the year before (or whose flow mask changed) and patches the
+    # previous year's outputs. Gives the same rasters as a full run of each year
+    if engine == 'recursive':
+        engine = 'vectorized'
+    fdr, fdr_no_data = read_fdr(input_files(basin, years[0])[1])
+    if compact:
+        fdr, fdr_no_data = compact_fdr(fdr, fdr_no_data)
+    keep = keep_table([(forest, nonforest) for _, forest, nonforest in scenarios])
+    graph = None
+
+    prev = None
+    for year in years:
+        metrics = run_metrics(f"{basin}_{year}", basin, 'incremental', engine, year=year)
+        lc_file, _, dist_mask_file = input_files(basin, year)
+        with metrics.stage('read'):
+            lc, dist_mask, georef = read_year(lc_file, dist_mask_file)
+        metrics.values['cells'] = lc.size
+        with metrics.stage('mask'):
+            if compact:
+                lc, dist_mask = compact_lc(lc), PackedMask(dist_mask)
+
+        start = dt.now()
+        if prev is None:
+            with metrics.stage('traverse', profile=True):
+                resolved = resolve(lc, fdr, dist_mask, fdr_no_data, engine, keep, max(cutoffs))
+            with metrics.stage('buildup'):
+                results = assemble_sweep(lc.shape, resolved, cutoffs, compact)
         else:
-            outBand.SetNoDataValue(no_data)
+            with metrics.stage('traverse', profile=True):
+                if graph is None:
+                    # built once; the fdr is the same for every year
+                    graph = flow_graph(fdr, max(cutoffs), engine)
+                resolved, affected = update_resolved(prev, lc, fdr, dist_mask, fdr_no_data, graph, engine, keep,
+                                                     max(cutoffs))
+            writer.wait()   # the previous year's outputs are patched in place
+            with metrics.stage('buildup'):
+                patch_sweep(results, prev[2], resolved, affected, cutoffs)
+            metrics.values['re_resolved'] = int(np.count_nonzero(affected))
+            print(f"{basin}-{year}: {np.count_nonzero(affected)} of {affected.size} cells re-resolved")
+        metrics.count_starts(resolved[1], resolved[2])
+        print('Processing time: {}'.format(dt.now() - start))
+
+        write_sweep(results, basin, year, georef, scenarios, cutoffs, metrics)
+        save_metrics(metrics, basin)
+        prev = (lc, dist_mask, resolved)
+
+
+def traversibility_streaming(basin, year, memory_limit_mb=2048, engine='vectorized'):
+    # Streaming mode: reads the inputs in row bands (through GDAL, or from the memory-mapped input cache) and writes
+    # each band's outputs before moving on, so only a band plus its halo is ever in memory
+    lc_file, fdr_file, dist_mask_file = input_files(basin, year)
+    output_prefix = f'NoBuffer_{basin}_{year}_'
 
-        # georeference the image and set the projection
-        outDs.SetGeoTransform(geotransform)
-        outDs.SetProjection(projection)
-        print(f"Created {outfl}")
+    if cache_dir:
+        lc, meta = read_cached(lc_file, cache_dir)
+        fdr, fdr_meta = read_cached(fdr_file, cache_dir)
+        dist_mask, _ = read_cached(dist_mask_file, cache_dir)
+        fdr_no_data = fdr_meta['nodata']
+        georef = (gdal.GetDriverByName(meta['driver']), tuple(meta['geotransform']), meta['projection'])
+        shape = lc.shape
+        lc_ds = fdr_ds = dist_mask_ds = None
+
+        def read_window(row, rows):
+            return tuple(np.array(a[row:row + rows]) for a in (lc, fdr, dist_mask))
+    else:
+        lc_ds = gdal.Open(lc_file, 0)
+        fdr_ds = gdal.Open(fdr_file, 0)
+        dist_mask_ds = gdal.Open(dist_mask_file, 0)
+        fdr_no_data = fdr_ds.GetRasterBand(1).GetNoDataValue()
+        georef = (lc_ds.GetDriver(), lc_ds.GetGeoTransform(), lc_ds.GetProjection())
+        shape = (lc_ds.RasterYSize, lc_ds.RasterXSize)
+
+        def read_window(row, rows):
+            return tuple(ds.ReadAsArray(0, row, shape[1], rows) for ds in (lc_ds, fdr_ds, dist_mask_ds))
+    band_rows = band_height(shape[1], memory_limit_mb)
+    print(f"length: {shape[0]}, width: {shape[1]}, {band_rows} rows per band")
+    metrics = run_metrics(f"{basin}_{year}", basin, 'streaming', engine, year=year, band_rows=band_rows)
+    metrics.values['cells'] = shape[0] * shape[1]
+
+    with metrics.stage('write'):
+        outputs = {o: create_output(basin, output_prefix, o, shape, georef, stream_options) for o in output_names}
+
+    start = dt.now()
+    for o, row, block in traverse_bands(read_window, shape, fdr_no_data, band_rows, engine, metrics=metrics):
+        if o == 'hydist':
+            print(f"Processing row {row} of {shape[0]} ({100 * row / shape[0]:.1f}%)")
+        with metrics.stage('write'):
+            outputs[o][0].GetRasterBand(1).WriteArray(block, 0, row)
+    print('Processing time: {}'.format(dt.now() - start))
+
+    with metrics.stage('write'):
+        for o, (outDs, outfl) in outputs.items():
+            outDs.FlushCache()
+            print(f"Created {outfl}")
+    del outputs, lc_ds, fdr_ds, dist_mask_ds
+    save_metrics(metrics, basin)
+
+
+def traversibility_job(basin, year, fdr_spec, fdr_no_data, engine='vectorized', scenarios=scenarios):
+    # Scheduler job: one basin-year, with the basin's FDR attached from shared memory instead of read from disk
+    shm, fdr = attach_array(fdr_spec)
+    try:
+        # the metrics CSV is appended to by the parent process, see traversibility_parallel
+        metrics = run_metrics(f"{basin}_{year}", basin, 'parallel', engine, year=year)
+        lc_file, _, dist_mask_file = input_files(basin, year)
+        with metrics.stage('read'):
+            lc, dist_mask, georef = read_year(lc_file, dist_mask_file)
+        metrics.values['cells'] = lc.size
+        rates = [(forest, nonforest) for _, forest, nonforest in scenarios]
+        results = traverse_scenarios(lc, fdr, dist_mask, fdr_no_data, rates, engine, metrics=metrics)
+        write_sweep(results, basin, year, georef, scenarios, flow_lengths, metrics)
+        save_metrics(metrics, basin, add_to_csv=False)
+        writer.wait()
+    finally:
+        del fdr
+        shm.close()
+
+
+def traversibility_parallel(basins, years, workers=None, engine='vectorized'):
+    # Runs all basin-years concurrently. Each basin's FDR is read once into shared memory and used by all its years
+    shared, jobs, results = [], [], []
+    try:
+        for basin in basins:
+            try:
+                fdr, fdr_no_data = read_fdr(input_files(basin, years[0])[1])
+            except Exception:
+                error = traceback.format_exc()
+                results += [{'job': f"{basin}-{year}", 'status': 'failed', 'seconds': 0.0, 'error': error} for year in years]
+                continue
+            shm, fdr_spec = share_array(fdr)
+            del fdr
+            shared.append(shm)
+            jobs += [(f"{basin}-{year}", traversibility_job, (basin, year, fdr_spec, fdr_no_data, engine)) for year in years]
+
+        writer.wait()   # no write thread may be running while the pool forks its workers
+        results += run_jobs(jobs, workers)
+    finally:
+        for shm in shared:
+            shm.close()
+            shm.unlink()
+
+    # one metrics CSV row per finished job, written here so the worker processes don't append to the file concurrently
+    for basin, year in itertools.product(basins, years):
+        json_file = metrics_json(basin, f"{basin}_{year}")
+        if any(r['job'] == f"{basin}-{year}" and r['status'] == 'ok' for r in results) and os.path.exists(json_file):
+            with open(json_file) as f:
+                record = {k: v for k, v in json.load(f).items() if not isinstance(v, dict)}
+            append_csv(record, metrics_file)
+    return report_jobs(results)
 
 
 def main():
     basins = ["Cannonsville"]#["WestDelaware", "ElkCreek", "TownBrooke"]#["WestDelaware", "ElkCreek", "TownBrooke"]
     years = [1996, 2001, 2006, 2010, 2016, 2021]#[1996, 2001, 2006, 2010, 2016, 2021]
-    total = len(basins) * len(years)
-    count = 0
+
+    # 'multi_year':  trace each basin's flow paths once and score all years from them
+    # 'incremental': resolve each basin's first year, then only the cells affected by land cover changes
+    # 'parallel':    run basin-years concurrently in `workers` processes, sharing each basin's FDR
+    # 'streaming':   stream each basin-year in row bands under memory_limit_mb
+    # 'single':      one basin-year at a time, tiled over `workers` processes when workers > 1
+    mode = 'multi_year'
+    workers = 1
+    tile_size = 1024    # rows/columns per tile of the tiled engine
+    memory_limit_mb = 2048
+
     start_time=dt.now()
-    for basin, year in itertools.product(basins, years):
-        count += 1
-        print(f"\nProcessing {count}/{total}: {basin}-{year}\n")
-        try:
-            traversibility_algorithm(basin,year)        
-        except Exception as e:
-            print(f"Unexpected error during {basin}-{year}: {e}")
+    if mode == 'parallel':
+        traversibility_parallel(basins, years, workers)
+    elif mode in ('multi_year', 'incremental'):
+        for count, basin in enumerate(basins, 1):
+            print(f"\nProcessing {count}/{len(basins)}: {basin} {years[0]}-{years[-1]}\n")
+            try:
+                if mode == 'incremental':
+                    traversibility_incremental(basin, years)
+                else:
+                    traversibility_years(basin, years)
+            except Exception as e:
+                print(f"Unexpected error during {basin}: {e}")
+    else:
+        total = len(basins) * len(years)
+        count = 0
+        for basin, year in itertools.product(basins, years):
+            count += 1
+            print(f"\nProcessing {count}/{total}: {basin}-{year}\n")
+            try:
+                if mode == 'streaming':
+                    traversibility_streaming(basin, year, memory_limit_mb)
+                else:
+                    traversibility_algorithm(basin,year,workers=workers,tile_size=tile_size)
+            except Exception as e:
+                print(f"Unexpected error during {basin}-{year}: {e}")
+    try:
+        writer.wait()
+    except Exception as e:
+        print(f"Unexpected error while writing the outputs: {e}")
     end_time=dt.now()
     print(f"Total time taken : {end_time-start_time}")
         